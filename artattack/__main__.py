@@ -12,21 +12,43 @@ from .data import screenshot_path
 from .game import TwoPlayerController, HostController, ClientController
 from .text import Label
 from .menu import MainMenu
+from . import profiler
+from .assets import registry
 
 
 DEFAULT_PAINTING = 'desert-island2.png'
 
+TICK_RATE = 30  # simulation updates per second
+FPS = 60  # maximum frames drawn per second
+
+# If the simulation falls further behind than this many ticks in one frame,
+# drop the excess time rather than trying to catch up
+MAX_TICKS_PER_FRAME = 5
+
 
 class Game(object):
     """Wraps the Pygame initialisation/event loop system.
     
     All behaviour is delegated to a Gamestate
+
+    The gamestate is updated in fixed timesteps of 1 / tick_rate seconds,
+    independently of the rate at which frames are drawn. Gamestates may
+    define set_interpolation() to draw moving objects part way between the
+    last two ticks.
+
+    Each stage of the frame is timed; F3 toggles an overlay of the timings and
+    profile_log names a CSV or JSON lines file to record them to.
+
     """
 
-    def __init__(self):
+    def __init__(self, tick_rate=TICK_RATE, fps=FPS, profile_log=None):
         pygame.init()
         self.screen = pygame.display.set_mode((1024, 600))
         self.gamestate = None
+        self.tick_rate = tick_rate
+        self.fps = fps
+        self.profiler = profiler.FrameProfiler(log=profile_log)
+        profiler.install(self.profiler)
 
     def set_gamestate(self, gamestate):
         if self.gamestate:
@@ -42,47 +64,82 @@ class Game(object):
 
     def run(self):
         clock = pygame.time.Clock()
+        step = 1.0 / self.tick_rate
+        accumulator = 0.0
+
+        prof = self.profiler
 
         self.keeprunning = True
-        while self.keeprunning:
-            dt = clock.tick(30) / 1000.0
-            for event in pygame.event.get():
-                if event.type == QUIT:
-                    return
-                elif event.type == KEYDOWN:
-                    if event.key == K_ESCAPE:
-                        if isinstance(self.gamestate, MainMenu):
-                            return
-                        self.set_gamestate(MainMenu())
-                    elif event.key == K_F12:
-                        self.save_screenshot()
-                    self.gamestate.on_key(event)
-
-            self.gamestate.update(dt)
-            self.gamestate.draw(self.screen)
-
-            pygame.display.flip()
+        try:
+            while self.keeprunning:
+                accumulator += clock.tick(self.fps) / 1000.0
+                prof.start_frame()
+                with prof.section('events'):
+                    if not self.handle_events():
+                        return
+
+                with prof.section('update'):
+                    registry.poll()
+                    ticks = 0
+                    while accumulator >= step:
+                        self.gamestate.update(step)
+                        accumulator -= step
+                        ticks += 1
+                        if ticks >= MAX_TICKS_PER_FRAME:
+                            accumulator = 0.0
+                            break
+
+                with prof.section('draw'):
+                    set_interpolation = getattr(self.gamestate, 'set_interpolation', None)
+                    if set_interpolation:
+                        set_interpolation(accumulator / step)
+                    self.gamestate.draw(self.screen)
+                    prof.draw(self.screen)
+
+                with prof.section('flip'):
+                    pygame.display.flip()
+                prof.end_frame()
+        finally:
+            prof.close()
+
+    def handle_events(self):
+        """Dispatch pending events; return False if the game should quit."""
+        for event in pygame.event.get():
+            if event.type == QUIT:
+                return False
+            elif event.type == KEYDOWN:
+                if event.key == K_ESCAPE:
+                    if isinstance(self.gamestate, MainMenu):
+                        return False
+                    self.set_gamestate(MainMenu())
+                elif event.key == K_F12:
+                    self.save_screenshot()
+                elif event.key == K_F3:
+                    self.profiler.toggle()
+                self.gamestate.on_key(event)
+        return True
 
     def save_screenshot(self):
         pygame.image.save(self.screen, screenshot_path(datetime.datetime.now().strftime('screenshot_%Y-%m-%d_%H:%M:%S.png')))
 
 
-def menu():
-    game = Game()
+def menu(**game_options):
+    game = Game(**game_options)
+    registry.preload()
     game.set_gamestate(MainMenu())
     game.run()
     pygame.quit()
 
 
-def main(painting=DEFAULT_PAINTING, timelimit=120):
-    game = Game()
+def main(painting=DEFAULT_PAINTING, timelimit=120, **game_options):
+    game = Game(**game_options)
     game.set_gamestate(TwoPlayerController(painting, timelimit=timelimit))
     game.run()
     pygame.quit()
 
 
-def host(painting=DEFAULT_PAINTING, timelimit=120, port=None):
-    game = Game()
+def host(painting=DEFAULT_PAINTING, timelimit=120, port=None, **game_options):
+    game = Game(**game_options)
     kwargs = {}
     if port is not None:
         kwargs['port'] = port
@@ -91,8 +148,8 @@ def host(painting=DEFAULT_PAINTING, timelimit=120, port=None):
     pygame.quit()
 
 
-def connect(host, port=None):
-    game = Game()
+def connect(host, port=None, **game_options):
+    game = Game(**game_options)
     if port is not None:
         gs = ClientController(host, port)
     else:
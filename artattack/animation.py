@@ -1,27 +1,31 @@
-from pygame import transform
 from pygame.locals import *
 
-from .data import load_sprite, load_anim_def, load_sound
+from .cache import LRUCache
+from .assets import registry
+
+
+# Colourised copies of animation frames, keyed by (animation, RGBA colour).
+# Paintings each create their own PaintColours, so key on the colour value.
+colourised_frames = LRUCache(256)
 
 
 def sprite(name, off=(0, 0)):
     def load():
-        return Sprite(load_sprite(name + '.png'), off)
+        return Sprite(registry.surface(name + '.png'), off)
 
     return load
 
 
 def anim(name):
     def load():
-        return LayeredAnimation.from_file(name + '.txt')
+        return registry.animation(name)
 
     return load
 
 
 def mirror_anim(name):
-    # Not the most efficient way of doing it.
     def load():
-        return LayeredAnimation.from_file(name + '.txt').mirror()
+        return registry.animation(name, mirrored=True)
 
     return load
 
@@ -46,7 +50,7 @@ class Loadable(object):
         if not hasattr(cls, 'sounds'):
             sounds = {}
             for k, filename in cls.SOUNDS.iteritems():
-                sounds[k] = load_sound(filename)
+                sounds[k] = registry.sound(filename)
 
             cls.sounds = sounds
 
@@ -80,6 +84,7 @@ class AnimationInstance(object):
         self.frametime = 0
         self.finished = False
         self.colour = colour
+        self.frames = anim.get_frames(colour)
 
         self.on_finish_handlers = []
 
@@ -100,9 +105,7 @@ class AnimationInstance(object):
         self.frame = frame % len(self.anim.frames)
         
     def get_frame(self):
-        if self.colour:
-            return self.anim.colourised_frames[self.colour][self.frame]
-        return self.anim.frames[self.frame]
+        return self.frames[self.frame]
 
     def update(self, dt):
         if not self.playing:
@@ -138,10 +141,10 @@ class Animation(object):
     Animations can be configured to loop. 
     """
     INSTANCE_CLASS = AnimationInstance
+    is_colour_mask = False
 
     def __init__(self, frames, framerate=12, looping=True):
         self.frames = frames
-        self.colourised_frames = {}
         self.frametime = 1.0 / float(framerate)
         self.looping = looping
 
@@ -149,44 +152,46 @@ class Animation(object):
         """Generate a copy of the animation mirrored left-right."""
         flipped_frames = []
         for surface, offset in self.frames:
-            flipped = transform.flip(surface, True, False)
+            flipped = registry.flip(surface)
             offx, offy = offset
             offx = flipped.get_width() - offx
             flipped_frames.append((flipped, (offx, offy)))
-        return Animation(flipped_frames, 1.0 / self.frametime, self.looping)
+        inst = Animation(flipped_frames, 1.0 / self.frametime, self.looping)
+        inst.is_colour_mask = self.is_colour_mask
+        return inst
 
     def colourise(self, colour):
+        """Return copies of the frames multiplied by colour."""
         fs = []
         for surface, offset in self.frames:
             col = surface.copy()
             col.fill(colour.colour, None, BLEND_RGB_MULT)
             fs.append((col, offset))
-        self.colourised_frames[colour] = fs
+        return fs
+
+    def get_frames(self, colour=None):
+        """Get the frames of the animation, colourised if colour is given."""
+        if not colour:
+            return self.frames
+        key = (self, tuple(colour.colour))
+        return colourised_frames.get(key, lambda: self.colourise(colour))
 
     def create_instance(self, colour=None, started=True):
-        if colour is not None:
-            self.colourise(colour)
         inst = self.INSTANCE_CLASS(self, colour=colour)
         if started:
             inst.play()
         return inst
 
-    @classmethod
-    def from_file(cls, filename):
-        layers = load_anim_def(filename)
-        l = layers[0]
-        return cls.load_as_layer(*l)
-
     @classmethod
     def load_as_layer(cls, base, frames, offsets, is_colour_mask):
         if frames == 1:
-            surface = load_sprite(base + '.png')
+            surface = registry.surface(base + '.png')
             inst = cls([(surface, offsets[0])])
         else:
             fs = []
             for f in range(frames):
                 fname = '%s-%s.png' % (base, f + 1)
-                surface = load_sprite(fname)
+                surface = registry.surface(fname)
                 offset = offsets[f % len(offsets)]
                 fs.append((surface, offset))
             inst = cls(fs)
@@ -233,14 +238,3 @@ class LayeredAnimation(Animation):
     def mirror(self):
         ls = [l.mirror() for l in self.layers]
         return LayeredAnimation(ls)
-
-    def colourise(self, colour):
-        pass
-
-    @classmethod
-    def from_file(cls, filename):
-        layers = load_anim_def(filename)
-        ls = []
-        for l in layers:
-            ls.append(Animation.load_as_layer(*l))
-        return cls(ls)
@@ -0,0 +1,163 @@
+"""Compiled animation definitions.
+
+Animation definitions (data/anims/*.txt) are parsed all at once into a
+compiled form: a dict mapping each filename to a list of layers
+
+    (base, frames, offsets, is_colour_mask)
+
+The compiled form is stored in the user's cache directory, keyed by the
+modification times and sizes of the definition files, so that they are only
+parsed - and any problems with them reported - when they change. If there is
+an asset bundle, its compiled definitions are used instead, unless the files
+have changed since it was built.
+
+"""
+
+import os
+import re
+import sys
+import cPickle as pickle
+
+from .data import filepath, get_bundle, warn_stale_bundle
+from .cache import DiskCache
+
+
+# Name of the compiled definitions in the asset bundle
+BUNDLE_NAME = 'anims.pickle'
+
+# Change this when the compiled format changes
+COMPILED_VERSION = 1
+
+cache = DiskCache('anims', max_size=1024 * 1024)
+compiled = None
+
+
+anim_comment_re = re.compile(r'#.*$')
+anim_line_re = re.compile(r'^(?P<key>base|frames|colour|offsets):\s*(?P<value>.*)$')
+
+def parse(f, filename):
+    """Parse an animation definition file, f, into a list of layers."""
+
+    layers = []
+    base = None
+    frames = None
+    offsets = []
+    colour = False
+    for line, l in enumerate(f):
+        line += 1
+        l = anim_comment_re.sub('', l).rstrip()
+        if not l:
+            continue
+
+        mo = anim_line_re.match(l)
+        if not mo:
+            print >>sys.stderr, "Warning: failed to parse animation (%s, line %d)" % (filename, line)
+            continue
+
+        key = mo.group('key')
+        value = mo.group('value')
+
+        if key == 'base':
+            if base:
+                if not frames:
+                    print >>sys.stderr, "Warning: animation layer %s missing frames (%s, line %d)" % (base, filename, line)
+                elif not offsets:
+                    print >>sys.stderr, "Warning: animation layer %s missing offsets (%s, line %d)" % (base, filename, line)
+                else: 
+                    layers.append((base, frames, offsets, colour))
+
+            base = value
+            frames = None
+            offsets = []
+            colour = False
+        elif key == 'frames':
+            frames = int(value)
+        elif key == 'colour':
+            colour = value.lower() == 'true'
+        elif key == 'offsets':
+            coords = value.split(' ')
+            offsets = []
+            for c in coords:
+                if c == '-':
+                    offsets.append(None)
+                else:
+                    x, y = c.split(',')
+                    offsets.append((int(x), int(y)))
+    if base:
+        if not frames:
+            print >>sys.stderr, "Warning: animation layer %s missing frames (%s, line %d)" % (base, filename, line)
+        elif not offsets:
+            print >>sys.stderr, "Warning: animation layer %s missing offsets (%s, line %d)" % (base, filename, line)
+        else: 
+            layers.append((base, frames, offsets, colour))
+
+    return layers
+
+
+def compile_all():
+    """Parse all the animation definitions."""
+    defs = {}
+    for filename in sorted(os.listdir(filepath('anims'))):
+        if filename.endswith('.txt'):
+            with open(filepath(filename, subdir='anims'), 'r') as f:
+                defs[filename] = parse(f, filename)
+    return defs
+
+
+def dumps(defs):
+    return pickle.dumps(defs, pickle.HIGHEST_PROTOCOL)
+
+
+def source_key():
+    """Derive a cache key from the state of the definition files."""
+    parts = [COMPILED_VERSION]
+    for filename in sorted(os.listdir(filepath('anims'))):
+        if filename.endswith('.txt'):
+            st = os.stat(filepath(filename, subdir='anims'))
+            parts.extend([filename, st.st_mtime, st.st_size])
+    return DiskCache.make_key(*parts)
+
+
+def load_cached():
+    """Load the compiled definitions from the cache, compiling them if needed."""
+    key = source_key()
+    data = cache.get(key)
+    if data is not None:
+        try:
+            return pickle.loads(data)
+        except Exception:
+            pass
+    defs = compile_all()
+    cache.put(key, dumps(defs))
+    return defs
+
+
+def bundle_is_current(bundle):
+    """Check that the bundled definitions were compiled from the current files."""
+    try:
+        key = source_key()
+    except OSError:
+        return True  # the definition files aren't shipped; only the bundle is
+    if bundle.get_info(BUNDLE_NAME).get('source_key') == key:
+        return True
+    warn_stale_bundle()
+    return False
+
+
+def get_compiled():
+    global compiled
+    if compiled is None:
+        bundle = get_bundle()
+        if bundle and BUNDLE_NAME in bundle and bundle_is_current(bundle):
+            compiled = pickle.loads(bundle.get_bytes(BUNDLE_NAME))
+        else:
+            compiled = load_cached()
+    return compiled
+
+
+def get_anim_def(filename):
+    """Get the layers of the animation defined in filename."""
+    try:
+        return get_compiled()[filename]
+    except KeyError:
+        raise IOError("No animation definition %s" % filename)
@@ -1,17 +1,90 @@
 """Classes to represent artworks - the originals and the copies."""
 
+import os
+import hashlib
+from itertools import izip
+
 import pygame
 from pygame.locals import *
 
 from cStringIO import StringIO
 
-from .data import filepath
+try:
+    import numpy
+    from pygame import surfarray
+except ImportError:
+    numpy = None
+
+from .data import filepath, is_headless
 from .paint import PaintColour
+from .cache import DiskCache
+from .canvas import Canvas
 
 
 PAINTINGS_DIR = 'paintings'
 OUTLINE_COLOUR = pygame.color.Color('#00000033')
 BORDER_COLOUR = pygame.color.Color('#00000066')
+PREVIEW_SIZE = (240, 160)
+
+# Outlines and previews generated from paintings, keyed by painting content
+surface_cache = DiskCache('surfaces')
+
+# Change this when the way outlines or previews are drawn changes, eg. their
+# colours, so that surfaces cached by earlier versions aren't used
+SURFACE_CACHE_VERSION = 1
+
+# Paintings received from network hosts, keyed by the digest of their content
+painting_cache = DiskCache('paintings')
+
+# Filenames of the paintings shipped with the game, keyed by the digest of
+# their content. This is built the first time it is needed.
+painting_digests = None
+
+
+def get_painting_digests():
+    global painting_digests
+    if painting_digests is None:
+        digests = {}
+        for fname in os.listdir(filepath(PAINTINGS_DIR)):
+            with open(filepath(fname, subdir=PAINTINGS_DIR), 'rb') as f:
+                digests[hashlib.sha1(f.read()).hexdigest()] = fname
+        painting_digests = digests
+    return painting_digests
+
+
+def load_cached_surface(key, size, format):
+    """Load a surface from raw pixels in the surface cache, or return None."""
+    data = surface_cache.get(key)
+    if data is None:
+        return None
+    w, h = size
+    if len(data) != w * h * len(format):
+        return None
+    return pygame.image.fromstring(data, size, format)
+
+
+def save_cached_surface(key, surface, format):
+    surface_cache.put(key, pygame.image.tostring(surface, format))
+
+
+def canonical_indices(palette):
+    """Build a table mapping each index of palette to the first index with the
+    same colour.
+
+    Palettes may contain duplicate colours; comparing pixels through this table
+    gives the same result as comparing their colours.
+
+    """
+    lookup = range(256)
+    first = {}
+    for i, c in enumerate(palette):
+        lookup[i] = first.setdefault(tuple(c), i)
+    return lookup
+
+
+def count_matching(a, b):
+    """Count the positions at which the strings a and b are equal."""
+    return sum(1 for p, q in izip(a, b) if p == q)
 
 
 class Painting(object):
@@ -25,6 +98,35 @@ class Painting(object):
     def __init__(self, filename):
         self.load(filename)
 
+    @classmethod
+    def from_pngdata(cls, pngdata):
+        """Create a painting from the contents of a PNG file."""
+        painting = cls.__new__(cls)
+        painting.__setstate__({'pngdata': pngdata})
+        return painting
+
+    @classmethod
+    def from_digest(cls, digest):
+        """Find the painting whose PNG data has the hex SHA-1 digest digest.
+
+        Both the paintings directory and the painting cache are searched.
+        Returns None if the painting isn't found.
+
+        """
+        pngdata = painting_cache.get(digest)
+        if pngdata is None:
+            fname = get_painting_digests().get(digest)
+            if fname is not None:
+                with open(filepath(fname, subdir=PAINTINGS_DIR), 'rb') as f:
+                    pngdata = f.read()
+        if pngdata is None or hashlib.sha1(pngdata).hexdigest() != digest:
+            return None
+        return cls.from_pngdata(pngdata)
+
+    def cache(self):
+        """Store the painting so that from_digest() can find it in future."""
+        painting_cache.put(self.digest, self.pngdata)
+
     def load(self, filename):
         fpath = filepath(filename, subdir=PAINTINGS_DIR)
 
@@ -34,7 +136,13 @@ class Painting(object):
 
     def set_painting(self, surf):
         self.painting = surf
-        self.surface = pygame.transform.scale(self.painting, (240, 160)).convert()
+        self.canvas = Canvas.from_surface(surf)
+        self.canvas.translate(canonical_indices(surf.get_palette()))
+        self.digest = hashlib.sha1(self.pngdata).hexdigest()
+        if is_headless():
+            self.surface = None
+        else:
+            self.surface = self.build_preview_surface(*PREVIEW_SIZE).convert()
         self.palette = [PaintColour(i, c) for i, c in enumerate(self.painting.get_palette())]
 
     def __getstate__(self):
@@ -43,7 +151,8 @@ class Painting(object):
         }
 
     def __setstate__(self, state):
-        self.set_painting(pygame.image.load(StringIO(state['pngdata'])))
+        self.pngdata = state['pngdata']
+        self.set_painting(pygame.image.load(StringIO(self.pngdata)))
 
     def get_palette(self):
         return self.palette 
@@ -54,7 +163,34 @@ class Painting(object):
             m[c.index] = c
         return m
 
+    def cache_key(self, kind, size):
+        w, h = size
+        return DiskCache.make_key(SURFACE_CACHE_VERSION, self.digest, kind, w, h)
+
+    def build_preview_surface(self, sw, sh):
+        """Scale the painting up for display, reusing a cached copy if possible."""
+        key = self.cache_key('preview', (sw, sh))
+        preview = load_cached_surface(key, (sw, sh), 'RGB')
+        if preview is None:
+            preview = pygame.transform.scale(self.painting, (sw, sh))
+            save_cached_surface(key, preview, 'RGB')
+        return preview
+
     def build_outline_surface(self, sw, sh):
+        """Get the guidelines for the painting at size sw x sh.
+
+        Outlines are cached on disk, so they only need to be generated the
+        first time a painting is played.
+
+        """
+        key = self.cache_key('outlines', (sw, sh))
+        outlines = load_cached_surface(key, (sw, sh), 'RGBA')
+        if outlines is None:
+            outlines = self.generate_outline_surface(sw, sh)
+            save_cached_surface(key, outlines, 'RGBA')
+        return outlines
+
+    def generate_outline_surface(self, sw, sh):
         """Generate partially transparent guidelines to show where players should paint.
         """
         outlines = pygame.Surface((sw, sh), pygame.SRCALPHA)
@@ -63,6 +199,46 @@ class Painting(object):
         xstep = sw // w
         ystep = sh // h
 
+        if numpy is not None:
+            self.draw_outlines_numpy(outlines, xstep, ystep)
+        else:
+            self.draw_outlines_slow(outlines, xstep, ystep)
+        pygame.draw.rect(outlines, BORDER_COLOUR, Rect((0, 0), (xstep * w, ystep * h)), 1)
+        return outlines
+
+    def draw_outlines_numpy(self, outlines, xstep, ystep):
+        """Find colour boundaries with array diffs and rasterise them all at once."""
+        w, h = self.painting.get_size()
+        sw, sh = outlines.get_size()
+        idx = self.canvas.array().T
+
+        # Cells whose left/top edge is a boundary between two colours
+        left = numpy.zeros((w, h), dtype=bool)
+        left[1:, :] = idx[1:, :] != idx[:-1, :]
+        top = numpy.zeros((w, h), dtype=bool)
+        top[:, 1:] = idx[:, 1:] != idx[:, :-1]
+
+        # Like pygame.draw.line, each segment covers step + 1 pixels
+        xs = (numpy.arange(w) * xstep)[:, None]
+        ys = (numpy.arange(h) * ystep)[None, :]
+        mask = numpy.zeros((w * xstep + 1, h * ystep + 1), dtype=bool)
+        for d in range(ystep + 1):
+            mask[xs, ys + d] |= left
+        for d in range(xstep + 1):
+            mask[xs + d, ys] |= top
+        mask = mask[:sw, :sh]
+        mw, mh = mask.shape
+
+        rgb = surfarray.pixels3d(outlines)
+        rgb[:mw, :mh][mask] = tuple(OUTLINE_COLOUR)[:3]
+        del rgb
+        alpha = surfarray.pixels_alpha(outlines)
+        alpha[:mw, :mh][mask] = OUTLINE_COLOUR.a
+        del alpha
+
+    def draw_outlines_slow(self, outlines, xstep, ystep):
+        """Draw the guidelines pixel by pixel, for when numpy is unavailable."""
+        w, h = self.painting.get_size()
         cy = 0
         for j in range(h):
             cx = 0
@@ -78,24 +254,32 @@ class Painting(object):
                         pygame.draw.line(outlines, OUTLINE_COLOUR, (cx, cy), (cx + xstep, cy))
                 cx += xstep  
             cy += ystep
-        pygame.draw.rect(outlines, BORDER_COLOUR, Rect((0, 0), (xstep * w, ystep * h)), 1)
-        return outlines
 
     def draw(self, screen):
         screen.blit(self.surface, (390, 55))
 
 
 class Artwork(object):
-    """A player's copy of an original painting."""
+    """A player's copy of an original painting.
+
+    The pixels are held in a Canvas of palette indices, which is what scoring
+    works from; the display surface is only ever drawn from the canvas.
+
+    """
     def __init__(self, painting, surface, rect, outlines=None):
-        """Create an artwork to copy painting occupying screen position rect."""
+        """Create an artwork to copy painting occupying screen position rect.
+
+        If surface is None the artwork is not rendered at all.
+
+        """
 
         self.painting = painting
-        self.artwork = self.painting.painting.copy()
+        w, h = self.painting.canvas.get_size()
+        self.canvas = Canvas(w, h)
+        self.palette = list(self.painting.painting.get_palette())
         self.surface = surface
 
         # Compute display dimensions of a pixel
-        w, h = self.artwork.get_size()
         self.rect = rect
         self.xpix = rect.width // w
         self.ypix = rect.height // h
@@ -108,22 +292,15 @@ class Artwork(object):
 
     @property
     def width(self):
-        return self.artwork.get_width()
+        return self.canvas.width
 
     @property
     def height(self):
-        return self.artwork.get_height()
+        return self.canvas.height
 
     def compute_completeness(self):
-        w, h = self.artwork.get_size()
-        correct = 0
-        for j in xrange(h):
-            for i in xrange(w):
-                orig = self.painting.painting.get_at((i, j))
-                art = self.artwork.get_at((i, j))
-                if orig == art:
-                    correct += 1
-        return correct
+        """Count the pixels of the artwork that match the painting."""
+        return self.canvas.count_equal(self.painting.canvas)
 
     def completeness(self):
         return self.correct, self.num_pixels
@@ -143,40 +320,113 @@ class Artwork(object):
     def blank(self):
         """Clear the artwork completely (paint it white)."""
         self.white = self.get_white()
-        self.artwork.fill(self.white)
-        
-        self.surface.fill((255, 255, 255))
-        if not self.outlines:
-            self.outlines = self.painting.build_outline_surface(self.rect.width, self.rect.height)
+        self.lookup = canonical_indices(self.palette)
+        self.canvas.fill(self.white)
         self.correct = self.compute_completeness()
 
+        if self.surface is not None:
+            self.surface.fill((255, 255, 255))
+            if not self.outlines:
+                self.outlines = self.painting.build_outline_surface(self.rect.width, self.rect.height)
+
     def get_white(self):
         """Find or set a white colour in the artwork palette, for blanking the canvas."""
         white = pygame.Color('#ffffff')
-        pal = self.artwork.get_palette()
         try:
-            return pal.index(white)
+            return self.palette.index(white)
         except ValueError:
-            pal = list(pal) + [white]
-            self.artwork.set_palette(pal)
-            return len(pal) - 1
+            self.palette.append(white)
+            return len(self.palette) - 1
 
     def paint_pixel(self, pixel, colour):
         """Paint a pixel a given colour, where pixel = (x, y)"""
-        colour = self.artwork.get_palette_at(colour)
-        old_colour = self.artwork.get_at(pixel)
-        if old_colour != colour:
-            orig = self.painting.painting.get_at(pixel)
-            if orig == colour:
-                self.correct += 1
-            elif orig == old_colour:
-                self.correct -= 1
-        self.artwork.set_at(pixel, colour)
-        x, y = pixel
+        self.paint_footprint(pixel, ((True,),), colour)
+
+    def clip_footprint(self, origin, footprint):
+        """Clip a footprint placed at origin to the bounds of the artwork.
+
+        Return the rectangle of artwork pixels covered and the (x, y) offset of
+        that rectangle within the footprint, or None if nothing is covered.
 
-        r = Rect(self.xpix * x, self.ypix * y, self.xpix, self.ypix)
+        """
+        x, y = origin
+        fw = len(footprint[0])
+        fh = len(footprint)
+        r = Rect(x, y, fw, fh).clip(Rect(0, 0, self.width, self.height))
+        if not r.width or not r.height:
+            return None
+        return r, (r.left - x, r.top - y)
+
+    def paint_footprint(self, origin, footprint, colour):
+        """Paint colour through a brush footprint.
+
+        footprint is a sequence of rows of booleans indicating which pixels are
+        painted; its top left corner is placed at pixel origin, which may lie
+        outside the artwork. The score is updated from the change in the
+        painted pixels and the display is updated once for the whole footprint.
 
-        self.surface.fill(colour, r)
+        """
+        clipped = self.clip_footprint(origin, footprint)
+        if clipped is None:
+            return
+        r, off = clipped
+        colour = self.lookup[colour]
+        if numpy is not None:
+            self.paint_footprint_numpy(r, off, footprint, colour)
+        else:
+            self.paint_footprint_slow(r, off, footprint, colour)
+        if self.surface is not None:
+            self.refresh(r)
+
+    def paint_footprint_numpy(self, r, off, footprint, colour):
+        ox, oy = off
+        mask = numpy.asarray(footprint, dtype=bool)[oy:oy + r.height, ox:ox + r.width]
+        target = self.painting.canvas.array()[r.top:r.bottom, r.left:r.right][mask]
+
+        region = self.canvas.array()[r.top:r.bottom, r.left:r.right]
+        before = region[mask]
+        region[mask] = colour
+
+        self.correct += int(numpy.count_nonzero(target == colour)) - int(numpy.count_nonzero(before == target))
+
+    def paint_footprint_slow(self, r, off, footprint, colour):
+        ox, oy = off
+        target = self.painting.canvas
+        for j in range(r.height):
+            row = footprint[oy + j]
+            y = r.top + j
+            for i in range(r.width):
+                if not row[ox + i]:
+                    continue
+                x = r.left + i
+                old_colour = self.canvas.get(x, y)
+                if old_colour != colour:
+                    orig = target.get(x, y)
+                    if orig == colour:
+                        self.correct += 1
+                    elif orig == old_colour:
+                        self.correct -= 1
+                self.canvas.set(x, y, colour)
+
+    def apply_tile(self, rect, data):
+        """Overwrite the pixels within rect (x, y, w, h) with data, a string of
+        canvas indices, eg. to repair the artwork from an authoritative copy.
+
+        The score and the display are updated to match.
+
+        """
+        target = self.painting.canvas.get_rect(rect)
+        before = self.canvas.get_rect(rect)
+        self.canvas.set_rect(rect, data)
+        self.correct += count_matching(data, target) - count_matching(before, target)
+        if self.surface is not None:
+            self.refresh(Rect(rect))
+
+    def refresh(self, r):
+        """Redraw the artwork pixels within rect r onto the display surface."""
+        size = (r.width * self.xpix, r.height * self.ypix)
+        scaled = pygame.transform.scale(self.canvas.to_surface(self.palette, r), size)
+        self.surface.blit(scaled, (r.left * self.xpix, r.top * self.ypix))
 
     def draw(self, screen):
         screen.blit(self.outlines, self.rect)
@@ -0,0 +1,209 @@
+"""A registry of the game's loaded assets.
+
+Every sprite, sound and animation is loaded through the registry, which
+decodes each file once and hands out the same objects to every class that
+uses them. Derived assets - mirrored surfaces, and the animation layers that
+colourised frames are made from - are built from the cached originals, so
+that eg. the paint layers common to both artists exist only once.
+
+At startup, preload() decodes every sprite and sound on worker threads while
+the menu runs. Surfaces can only be converted to the display format on the
+main thread, so the game loop calls poll() each frame to take in what the
+workers have decoded. Anything requested before it has been preloaded is
+simply loaded on the spot.
+
+Run this module to print the memory used by each asset:
+
+    python -m artattack.assets
+
+"""
+
+import os
+import sys
+import Queue
+import threading
+from timeit import default_timer
+
+from .data import load_sprite, decode_sprite, load_sound, filepath, is_headless
+from .animdefs import get_anim_def
+
+
+class AssetRegistry(object):
+    def __init__(self):
+        self.surfaces = {}  # sprite filename -> Surface
+        self.flipped = {}  # Surface -> Surface mirrored left-right
+        self.sounds = {}  # sound filename -> Sound
+        self.layers = {}  # layer definition -> Animation
+        self.animations = {}  # (anim name, mirrored) -> LayeredAnimation
+
+        self.preload_total = 0
+        self.preload_done = 0
+        self.decoded = Queue.Queue()
+
+    def surface(self, fname):
+        """Get the surface for the sprite file fname."""
+        try:
+            return self.surfaces[fname]
+        except KeyError:
+            s = self.surfaces[fname] = load_sprite(fname)
+            return s
+
+    def flip(self, surface):
+        """Get a copy of surface mirrored left-right."""
+        try:
+            return self.flipped[surface]
+        except KeyError:
+            from pygame import transform
+            s = self.flipped[surface] = transform.flip(surface, True, False)
+            return s
+
+    def sound(self, fname):
+        """Get the sound for the sound file fname."""
+        try:
+            return self.sounds[fname]
+        except KeyError:
+            s = self.sounds[fname] = load_sound(fname)
+            return s
+
+    def layer(self, base, frames, offsets, is_colour_mask):
+        """Get the animation for one layer of an animation definition."""
+        from .animation import Animation
+        key = (base, frames, tuple(offsets), is_colour_mask)
+        try:
+            return self.layers[key]
+        except KeyError:
+            l = self.layers[key] = Animation.load_as_layer(base, frames, offsets, is_colour_mask)
+            return l
+
+    def animation(self, name, mirrored=False):
+        """Get the layered animation defined in anims/<name>.txt."""
+        from .animation import LayeredAnimation
+        key = (name, mirrored)
+        try:
+            return self.animations[key]
+        except KeyError:
+            if mirrored:
+                a = self.animation(name).mirror()
+            else:
+                layers = [self.layer(*l) for l in get_anim_def(name + '.txt')]
+                a = LayeredAnimation(layers)
+            self.animations[key] = a
+            return a
+
+    def preload(self, workers=4):
+        """Start decoding every sprite and sound file on worker threads."""
+        if is_headless():
+            return
+        todo = Queue.Queue()
+        for kind, subdir, ext in [('sprite', 'sprites', '.png'), ('sound', 'sounds', '.wav')]:
+            for fname in sorted(os.listdir(filepath(subdir))):
+                if fname.endswith(ext):
+                    todo.put((kind, fname))
+        self.preload_total += todo.qsize()
+
+        for i in range(workers):
+            t = threading.Thread(target=self.decode_worker, args=(todo,))
+            t.daemon = True
+            t.start()
+
+    def decode_worker(self, todo):
+        while True:
+            try:
+                kind, fname = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if kind == 'sprite':
+                    asset = decode_sprite(fname)
+                else:
+                    asset = load_sound(fname)
+            except Exception:
+                # Leave it to be loaded (and the error reported) on demand
+                asset = None
+            self.decoded.put((kind, fname, asset))
+
+    def poll(self, budget=0.004):
+        """Add preloaded assets to the registry.
+
+        Stops after budget seconds so as not to hold up the frame.
+
+        """
+        if self.preload_done == self.preload_total:
+            return
+        start = default_timer()
+        while default_timer() - start < budget:
+            try:
+                kind, fname, asset = self.decoded.get_nowait()
+            except Queue.Empty:
+                break
+            self.preload_done += 1
+            if asset is None:
+                continue
+            if kind == 'sprite':
+                if fname not in self.surfaces:
+                    self.surfaces[fname] = asset.convert_alpha()
+            else:
+                self.sounds.setdefault(fname, asset)
+
+    def load_progress(self):
+        """Return the fraction of preloading that is complete."""
+        if not self.preload_total:
+            return 1.0
+        return float(self.preload_done) / self.preload_total
+
+    def memory_usage(self):
+        """Return a list of (bytes, kind, name) for each asset, largest first."""
+        usage = []
+        for fname, s in self.surfaces.iteritems():
+            usage.append((surface_size(s), 'sprite', fname))
+            if s in self.flipped:
+                usage.append((surface_size(self.flipped[s]), 'mirrored', fname))
+        for fname, s in self.sounds.iteritems():
+            usage.append((sound_size(s), 'sound', fname))
+        usage.sort(reverse=True)
+        return usage
+
+    def report(self, out=sys.stdout):
+        """Print the memory used by each asset."""
+        usage = self.memory_usage()
+        for size, kind, name in usage:
+            print >>out, '%8.1fK  %-9s %s' % (size / 1024.0, kind, name)
+        print >>out, '%8.1fK  total' % (sum(u[0] for u in usage) / 1024.0)
+
+
+def surface_size(surface):
+    return surface.get_pitch() * surface.get_height()
+
+
+def sound_size(sound):
+    import pygame.mixer
+    init = pygame.mixer.get_init()
+    if not init or not hasattr(sound, 'get_length'):
+        return 0
+    frequency, format, channels = init
+    return int(sound.get_length() * frequency) * channels * abs(format) // 8
+
+
+registry = AssetRegistry()
+
+
+def main():
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    import pygame
+    pygame.mixer.pre_init(44100, -16, 2, 1024)
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+
+    # Import the registry by name; when run with -m this module is __main__
+    from . import assets, game, menu, paint, player, tools, powerups
+    for cls in (menu.MainMenu, menu.JoinMenu, menu.GameMenu, menu.Brush,
+            game.GameplayGameState, game.StartGameState, game.EndGameState,
+            game.ConnectingGameState, paint.PaintColour, player.RedPlayer,
+            player.BluePlayer, tools.Brush):
+        cls.load()
+    powerups.PowerupFactory.load_all()
+    assets.registry.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""Benchmarks for the game's simulation hot paths.
+
+The benchmarks run in headless mode, driving players with scripted inputs.
+Run them with
+
+    python -m artattack.benchmark [--json] [-o FILE]
+
+to get a table of results, or JSON suitable for comparing runs.
+
+"""
+
+import os
+import sys
+import json
+import zlib
+import struct
+import random
+from timeit import default_timer
+
+from vector import Vector
+
+from artattack import VERSION_STRING
+from artattack import headless
+
+
+PAINTING = 'desert-island2.png'
+PALETTE = [
+    (255, 0, 0), (0, 255, 0), (0, 0, 255),
+    (255, 255, 0), (0, 255, 255), (255, 0, 255),
+]
+
+# Number of times to repeat each of the shorter timings, taking the best
+SAMPLES = 5
+
+ACTIONS = ['left', 'right', 'up', 'down', 'paint', 'paint', 'next_colour', 'attack']
+
+
+def timed(func, *args):
+    """Call func(*args) and return the time it took in seconds."""
+    start = default_timer()
+    func(*args)
+    return default_timer() - start
+
+
+def best_of(samples, func, *args):
+    """Call func(*args) samples times and return the shortest time taken.
+
+    The shortest time is the least disturbed by whatever else the machine
+    was doing.
+
+    """
+    return min(timed(func, *args) for i in xrange(samples))
+
+
+def png_chunk(tag, data):
+    crc = zlib.crc32(tag + data) & 0xffffffff
+    return struct.pack('!I', len(data)) + tag + data + struct.pack('!I', crc)
+
+
+def encode_png(width, height, palette, data):
+    """Encode rows of palette indices as an 8-bit paletted PNG.
+
+    pygame can't build paletted surfaces without a display, so we write the
+    PNG ourselves.
+
+    """
+    rows = ''.join('\0' + str(data[y * width:(y + 1) * width]) for y in xrange(height))
+    return ''.join([
+        '\x89PNG\r\n\x1a\n',
+        png_chunk('IHDR', struct.pack('!2I5B', width, height, 8, 3, 0, 0, 0)),
+        png_chunk('PLTE', ''.join(struct.pack('3B', *c) for c in palette)),
+        png_chunk('IDAT', zlib.compress(rows)),
+        png_chunk('IEND', ''),
+    ])
+
+
+def random_painting(width, height, seed=0):
+    """Generate a Painting of random pixels in the colours of PALETTE."""
+    from .artwork import Painting
+    rng = random.Random(seed)
+    data = bytearray(rng.randrange(len(PALETTE)) for i in xrange(width * height))
+    return Painting.from_pngdata(encode_png(width, height, PALETTE, data))
+
+
+def scripted_gamestate(seed=0):
+    g = headless.create_gamestate(PAINTING, timelimit=0)
+    g.world.give_all_colours()
+    g.world.on_pc_hit.connect(lambda pc, v: pc.hit(v))
+    return g, random.Random(seed)
+
+
+def bench_simulation(ticks, dt):
+    """Run a game with both players acting randomly each tick."""
+    g, rng = scripted_gamestate()
+    players = g.world.players
+
+    def run():
+        for i in xrange(ticks):
+            for p in players:
+                getattr(p, rng.choice(ACTIONS))()
+            g.update(dt)
+
+    elapsed = timed(run)
+    return {
+        'ticks': ticks,
+        'seconds': elapsed,
+        'ticks_per_sec': ticks / elapsed,
+    }
+
+
+def bench_paint(paints):
+    """Move the red player's brush around and paint as fast as possible."""
+    g, rng = scripted_gamestate()
+    player = g.world.red_player
+    moves = ['left', 'right', 'up', 'down']
+
+    def run():
+        for i in xrange(paints):
+            getattr(player, rng.choice(moves))()
+            player.paint()
+
+    elapsed = timed(run)
+    return {
+        'paints': paints,
+        'seconds': elapsed,
+        'paints_per_sec': paints / elapsed,
+    }
+
+
+def bench_collisions(actor_counts, repeats):
+    """Time World.handle_collisions() with increasing numbers of actors."""
+    from .world import Actor
+
+    class CrowdActor(Actor):
+        """An actor that collides with other CrowdActors but does nothing."""
+        COLLISION_GROUPS = 4
+        COLLISION_MASK = 4
+
+        def play(self, animation):
+            pass
+
+    results = []
+    for n in actor_counts:
+        g, rng = scripted_gamestate()
+        world = g.world
+        tl, br = world.get_floor_space()
+        for i in xrange(n):
+            x = tl.x + rng.random() * (br.x - tl.x)
+            y = tl.y + rng.random() * (br.y - tl.y)
+            world.spawn(CrowdActor(Vector([x, y])))
+
+        elapsed = best_of(SAMPLES, lambda: [world.handle_collisions() for i in xrange(repeats)])
+        results.append({
+            'actors': n,
+            'total_actors': len(world.actors),  # including the players
+            'usec_per_call': elapsed / repeats * 1e6,
+        })
+    return results
+
+
+def bench_completeness(sizes, repeats):
+    """Time Artwork.compute_completeness() for random paintings of each size."""
+    from .artwork import Artwork
+    from pygame import Rect
+
+    results = []
+    for w, h in sizes:
+        painting = random_painting(w, h)
+        artwork = Artwork(painting, None, Rect(0, 0, w, h))
+        elapsed = best_of(SAMPLES, lambda: [artwork.compute_completeness() for i in xrange(repeats)])
+        results.append({
+            'width': w,
+            'height': h,
+            'usec_per_call': elapsed / repeats * 1e6,
+        })
+    return results
+
+
+def run_all(ticks=3000, paints=3000, actor_counts=(2, 10, 50, 100, 200, 500), sizes=((36, 24), (72, 48), (144, 96), (288, 192), (576, 384)), repeats=20):
+    from .artwork import numpy
+    return {
+        'version': VERSION_STRING,
+        'python': sys.version.split()[0],
+        'numpy': numpy is not None,
+        'simulation': bench_simulation(ticks, 1.0 / 30),
+        'paint': bench_paint(paints),
+        'collisions': bench_collisions(actor_counts, repeats),
+        'completeness': bench_completeness(sizes, repeats),
+    }
+
+
+def print_results(r, out=sys.stdout):
+    print >>out, "Art Attack %s, Python %s, numpy %s" % (r['version'], r['python'], 'yes' if r['numpy'] else 'no')
+    print >>out
+    print >>out, "Simulation:   %10.1f ticks/s" % r['simulation']['ticks_per_sec']
+    print >>out, "Painting:     %10.1f paints/s" % r['paint']['paints_per_sec']
+    print >>out
+    print >>out, "handle_collisions(), N actors plus the two players"
+    for c in r['collisions']:
+        print >>out, "  %5d actors %12.1f us" % (c['actors'], c['usec_per_call'])
+    print >>out
+    print >>out, "compute_completeness()"
+    for c in r['completeness']:
+        print >>out, "  %4dx%-4d    %12.1f us" % (c['width'], c['height'], c['usec_per_call'])
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-j', '--json', action='store_true', help='Output results as JSON')
+    parser.add_option('-o', '--output', help='Write results to FILE', metavar='FILE')
+    parser.add_option('-t', '--ticks', type='int', default=3000, help='Number of simulation ticks to run')
+    parser.add_option('-p', '--paints', type='int', default=3000, help='Number of paint operations to run')
+    options, args = parser.parse_args()
+
+    # Keep pygame's banner out of the results
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    headless.init()
+    results = run_all(ticks=options.ticks, paints=options.paints)
+
+    if options.output:
+        out = open(options.output, 'w')
+    else:
+        out = sys.stdout
+    try:
+        if options.json:
+            json.dump(results, out, indent=2, sort_keys=True)
+            out.write('\n')
+        else:
+            print_results(results, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
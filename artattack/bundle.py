@@ -0,0 +1,108 @@
+"""Build the asset bundle.
+
+Packs every sprite and sound, plus the compiled animation definitions, into
+data/assets.bundle, which artattack.data loads in preference to the individual
+files. Sprites are stored already decoded, as RGBA, so that loading them is
+just a matter of pointing a surface at the right part of the memory-mapped
+bundle.
+
+Files that have changed since the bundle was built are loaded from data/
+instead, with a warning. Rebuild the bundle after changing anything there:
+
+    python -m artattack.bundle
+
+"""
+
+import os
+import sys
+import json
+
+from .data import filepath, bundle_path, BUNDLE_MAGIC, BUNDLE_HEADER
+from . import animdefs
+
+
+# (subdirectory, extension) of the files to bundle
+CONTENTS = [
+    ('sprites', '.png'),
+    ('sounds', '.wav'),
+]
+
+# Align each file's data to this many bytes
+ALIGNMENT = 16
+
+
+def read_sprite(path):
+    import pygame.image
+    surface = pygame.image.load(path)
+    w, h = surface.get_size()
+    return pygame.image.tostring(surface, 'RGBA'), {'width': w, 'height': h}
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read(), {}
+
+
+def source_info(path):
+    """Record the state of a source file, to detect when it changes."""
+    st = os.stat(path)
+    return {'mtime': st.st_mtime, 'source_size': st.st_size}
+
+
+def collect():
+    """Return a list of (name, data, info) for each file to bundle."""
+    entries = []
+    for subdir, ext in CONTENTS:
+        for fname in sorted(os.listdir(filepath(subdir))):
+            if not fname.endswith(ext):
+                continue
+            path = filepath(fname, subdir=subdir)
+            if subdir == 'sprites':
+                data, info = read_sprite(path)
+            else:
+                data, info = read_file(path)
+            info.update(source_info(path))
+            entries.append(('%s/%s' % (subdir, fname), data, info))
+    entries.append((animdefs.BUNDLE_NAME, animdefs.dumps(animdefs.compile_all()),
+        {'source_key': animdefs.source_key()}))
+    return entries
+
+
+def build(output=bundle_path):
+    entries = collect()
+
+    index = {}
+    offset = 0
+    for name, data, info in entries:
+        info.update(offset=offset, size=len(data))
+        index[name] = info
+        offset += len(data) + (-len(data) % ALIGNMENT)
+
+    index_data = json.dumps(index, sort_keys=True)
+    # Pad the index so that the data starts aligned too
+    index_data += ' ' * (-(BUNDLE_HEADER.size + len(index_data)) % ALIGNMENT)
+
+    tmp = output + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, len(index_data)))
+        f.write(index_data)
+        for name, data, info in entries:
+            f.write(data)
+            f.write('\0' * (-len(data) % ALIGNMENT))
+    os.rename(tmp, output)
+    return len(entries), os.path.getsize(output)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [-o FILE]')
+    parser.add_option('-o', '--output', default=bundle_path, help='File to write the bundle to')
+    options, args = parser.parse_args()
+
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    count, size = build(options.output)
+    print >>sys.stderr, "Wrote %d files (%.1fMB) to %s" % (count, size / 1048576.0, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Caches for data that is expensive to compute but rarely changes."""
+
+import os
+import hashlib
+from collections import OrderedDict
+
+from .data import cache_path
+
+
+class LRUCache(object):
+    """An in-memory cache of at most maxsize items.
+
+    When full, the least recently used item is discarded. Counts of hits and
+    misses are kept to help with tuning maxsize.
+
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, create):
+        """Return the item for key, calling create() to make it if it isn't cached."""
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            value = create()
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.items[key] = value
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class DiskCache(object):
+    """A content-addressed store of byte strings in the user's cache directory.
+
+    Keys should be derived from the content that the cached data was computed
+    from (see make_key()), so entries never need to be invalidated. As the
+    code that computes the data can change too, keys should also include a
+    version number that is incremented when it does. Once the total size of
+    the store exceeds max_size the least recently used entries are deleted.
+
+    The cache is purely an optimisation: failures to read or write are
+    ignored.
+
+    """
+    def __init__(self, subdir, max_size=16 * 1024 * 1024):
+        self.path = cache_path(subdir)
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(*parts):
+        """Derive a key from a sequence of strings."""
+        h = hashlib.sha1()
+        for p in parts:
+            h.update(str(p))
+            h.update('\0')
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """Return the data stored for key, or None if there is none."""
+        fname = self.filename(key)
+        try:
+            with open(fname, 'rb') as f:
+                data = f.read()
+            # Mark the entry as recently used
+            os.utime(fname, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        """Store data for key, evicting old entries if the cache is full."""
+        fname = self.filename(key)
+        tmp = fname + '.tmp'
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, fname)
+        except (IOError, OSError):
+            return
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_size."""
+        entries = []
+        total = 0
+        try:
+            for name in os.listdir(self.path):
+                st = os.stat(os.path.join(self.path, name))
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+        except OSError:
+            return
+
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                continue
+            total -= size
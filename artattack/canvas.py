@@ -0,0 +1,154 @@
+"""A compact model of a paletted image that does not depend on pygame.
+
+Canvases store one palette index per pixel in a flat bytearray, row by row.
+This is all the game simulation and scoring need; pygame surfaces are only
+built from a canvas when it needs to be drawn.
+
+"""
+
+import zlib
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The size of the square tiles that a canvas is checksummed in
+TILE_SIZE = 8
+
+
+class Canvas(object):
+    """A width x height grid of palette indices."""
+
+    def __init__(self, width, height, data=None, fill=0):
+        self.width = width
+        self.height = height
+        if data is None:
+            self.data = bytearray(chr(fill)) * (width * height)
+        else:
+            self.data = bytearray(data)
+            if len(self.data) != width * height:
+                raise ValueError("Canvas data is %d bytes, expected %d" % (len(self.data), width * height))
+
+    def __eq__(self, ano):
+        return isinstance(ano, Canvas) and self.get_size() == ano.get_size() and self.data == ano.data
+
+    def __ne__(self, ano):
+        return not self == ano
+
+    def get_size(self):
+        return self.width, self.height
+
+    def get(self, x, y):
+        return self.data[y * self.width + x]
+
+    def set(self, x, y, index):
+        self.data[y * self.width + x] = index
+
+    def fill(self, index):
+        self.data[:] = bytearray(chr(index)) * len(self.data)
+
+    def row(self, y, x1=0, x2=None):
+        """Return a copy of the pixels x1 <= x < x2 of row y."""
+        if x2 is None:
+            x2 = self.width
+        start = y * self.width
+        return self.data[start + x1:start + x2]
+
+    def set_row(self, y, x1, pixels):
+        """Overwrite the pixels of row y, starting at x1."""
+        start = y * self.width + x1
+        self.data[start:start + len(pixels)] = pixels
+
+    def get_rect(self, rect):
+        """Return the pixels within rect (x, y, w, h), row by row, as a string."""
+        x, y, w, h = rect
+        return ''.join(str(self.row(j, x, x + w)) for j in xrange(y, y + h))
+
+    def set_rect(self, rect, data):
+        """Overwrite the pixels within rect (x, y, w, h) with data, row by row."""
+        x, y, w, h = rect
+        if len(data) != w * h:
+            raise ValueError("Rect data is %d bytes, expected %d" % (len(data), w * h))
+        for j in xrange(h):
+            self.set_row(y + j, x, data[j * w:(j + 1) * w])
+
+    def tile_rects(self, size=TILE_SIZE):
+        """Return the rects (x, y, w, h) of the tiles covering the canvas, row
+        by row. Tiles at the right and bottom edges are cropped to fit."""
+        return [(x, y, min(size, self.width - x), min(size, self.height - y))
+            for y in xrange(0, self.height, size)
+            for x in xrange(0, self.width, size)]
+
+    def tiles_overlapping(self, rect, size=TILE_SIZE):
+        """Return the indices in tile_rects() of the tiles that overlap rect."""
+        x, y, w, h = rect
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + w, self.width), min(y + h, self.height)
+        if x1 >= x2 or y1 >= y2:
+            return []
+        across = (self.width + size - 1) // size
+        return [j * across + i
+            for j in xrange(y1 // size, (y2 - 1) // size + 1)
+            for i in xrange(x1 // size, (x2 - 1) // size + 1)]
+
+    def tile_checksums(self, size=TILE_SIZE):
+        """Return the Adler-32 checksum of each tile, in tile_rects() order."""
+        return [zlib.adler32(self.get_rect(r)) & 0xffffffff for r in self.tile_rects(size)]
+
+    def view(self):
+        """Return a memoryview of the pixel data, without copying it."""
+        return memoryview(self.data)
+
+    def array(self):
+        """Return a numpy array of the pixel data, indexed [y, x].
+
+        The array shares memory with the canvas, so writes to it change the
+        canvas.
+
+        """
+        return numpy.frombuffer(self.data, dtype=numpy.uint8).reshape(self.height, self.width)
+
+    def translate(self, table):
+        """Map every pixel through table, a sequence of 256 palette indices."""
+        self.data = self.data.translate(bytearray(table))
+
+    def copy(self):
+        return Canvas(self.width, self.height, self.data)
+
+    def snapshot(self):
+        """Return an immutable copy of the pixel data."""
+        return str(self.data)
+
+    def count_equal(self, ano):
+        """Count the pixels that are the same in this canvas and ano."""
+        if numpy is not None:
+            return int(numpy.count_nonzero(self.array() == ano.array()))
+        return sum(1 for a, b in izip(self.data, ano.data) if a == b)
+
+    def diff(self, ano):
+        """Return a list of the (x, y) positions of pixels that differ from ano."""
+        w = self.width
+        return [(i % w, i // w) for i, (a, b) in enumerate(izip(self.data, ano.data)) if a != b]
+
+    @classmethod
+    def from_surface(cls, surface):
+        """Create a canvas holding the palette indices of an 8-bit surface."""
+        import pygame.image
+        w, h = surface.get_size()
+        return cls(w, h, pygame.image.tostring(surface, 'P'))
+
+    def to_surface(self, palette, rect=None):
+        """Render the canvas (or the area rect of it) as an 8-bit surface."""
+        import pygame.image
+        if rect is None:
+            data = str(self.data)
+            size = self.get_size()
+        else:
+            x, y, w, h = rect
+            data = self.get_rect(rect)
+            size = (w, h)
+        surface = pygame.image.fromstring(data, size, 'P')
+        surface.set_palette(palette)
+        return surface
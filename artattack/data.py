@@ -1,15 +1,41 @@
 '''Simple data loader module.
 
 Loads data files from the "data" directory shipped with a game.
+
+If data/assets.bundle exists (see artattack.bundle), sprites and sounds are
+read from it rather than from the individual files, unless a file has changed
+since the bundle was built.
 '''
 
 import sys
 import os
-import re
+import mmap
+import json
+import struct
+import threading
+from cStringIO import StringIO
 
 
 data_py = os.path.abspath(os.path.dirname(__file__))
 data_dir = os.path.normpath(os.path.join(data_py, '..', 'data'))
+cache_dir = os.path.join(os.path.expanduser('~'), '.artattack', 'cache')
+bundle_path = os.path.join(data_dir, 'assets.bundle')
+
+# In headless mode nothing is loaded that needs a display or audio device
+headless = False
+
+
+def set_headless(enabled=True):
+    '''Switch headless mode on or off.
+
+    This must be done before any classes are loaded.
+    '''
+    global headless
+    headless = enabled
+
+
+def is_headless():
+    return headless
 
 
 def filepath(filename, subdir=None):
@@ -27,6 +53,15 @@ def screenshot_path(filename):
     return os.path.join(data_dir, '..', 'screenshots', filename)
 
 
+def cache_path(filename, subdir=None):
+    '''Determine the path to a file in the user's cache directory.
+    '''
+    if subdir:
+        return os.path.join(cache_dir, subdir, filename)
+    else:
+        return os.path.join(cache_dir, filename)
+
+
 def load(filename, mode='rb'):
     '''Open a file in the data directory.
 
@@ -35,78 +70,144 @@ def load(filename, mode='rb'):
     return open(os.path.join(data_dir, filename), mode)
 
 
-anim_comment_re = re.compile(r'#.*$')
-anim_line_re = re.compile(r'^(?P<key>base|frames|colour|offsets):\s*(?P<value>.*)$')
+BUNDLE_MAGIC = 'ArtAtk\x00\x02'
+BUNDLE_HEADER = struct.Struct('!8sI')  # magic, length of the JSON index
+
+
+class Bundle(object):
+    '''A pack of data files, memory-mapped for reading.
 
-def load_anim_def(filename):
-    '''Open an animation definition file and parse the contents.
+    The file is a header, then a JSON index mapping each name (eg.
+    "sprites/hit.png") to the offset and size of its data, plus a width and
+    height for sprites, which are stored decoded as RGBA. The mtime and size
+    of each source file are recorded too, so that stale entries can be
+    detected.
     '''
-    f = open(os.path.join(data_dir, 'anims', filename), 'r')
-
-    layers = []
-    base = None
-    frames = None
-    offsets = []
-    colour = False
-    for line, l in enumerate(f):
-        line += 1
-        l = anim_comment_re.sub('', l).rstrip()
-        if not l:
-            continue
-
-        mo = anim_line_re.match(l)
-        if not mo:
-            print >>sys.stderr, "Warning: failed to parse animation (%s, line %d)" % (filename, line)
-            continue
-
-        key = mo.group('key')
-        value = mo.group('value')
-
-        if key == 'base':
-            if base:
-                if not frames:
-                    print >>sys.stderr, "Warning: animation layer %s missing frames (%s, line %d)" % (base, filename, line)
-                elif not offsets:
-                    print >>sys.stderr, "Warning: animation layer %s missing offsets (%s, line %d)" % (base, filename, line)
-                else: 
-                    layers.append((base, frames, offsets, colour))
-
-            base = value
-            frames = None
-            offsets = []
-            colour = False
-        elif key == 'frames':
-            frames = int(value)
-        elif key == 'colour':
-            colour = value.lower() == 'true'
-        elif key == 'offsets':
-            coords = value.split(' ')
-            offsets = []
-            for c in coords:
-                if c == '-':
-                    offsets.append(None)
-                else:
-                    x, y = c.split(',')
-                    offsets.append((int(x), int(y)))
-    if base:
-        if not frames:
-            print >>sys.stderr, "Warning: animation layer %s missing frames (%s, line %d)" % (base, filename, line)
-        elif not offsets:
-            print >>sys.stderr, "Warning: animation layer %s missing offsets (%s, line %d)" % (base, filename, line)
-        else: 
-            layers.append((base, frames, offsets, colour))
-
-    return layers
 
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, index_size = BUNDLE_HEADER.unpack_from(self.map)
+        if magic != BUNDLE_MAGIC:
+            raise ValueError("%s is not an asset bundle" % path)
+        start = BUNDLE_HEADER.size
+        self.index = json.loads(self.map[start:start + index_size])
+        self.base = start + index_size
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get_info(self, name):
+        return self.index[name]
+
+    def get_buffer(self, name):
+        '''Return a buffer over the data for name, without copying it.'''
+        entry = self.index[name]
+        return buffer(self.map, self.base + entry['offset'], entry['size'])
+
+    def get_bytes(self, name):
+        entry = self.index[name]
+        start = self.base + entry['offset']
+        return self.map[start:start + entry['size']]
 
+    def is_current(self, name, path):
+        '''Check that the bundled copy of name matches the file at path.
 
+        If the file doesn't exist the bundled copy is the only one, and so
+        counts as current.
+        '''
+        entry = self.index[name]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return True
+        if st.st_mtime == entry.get('mtime') and st.st_size == entry.get('source_size'):
+            return True
+        warn_stale_bundle()
+        return False
+
+
+bundle = None
+bundle_lock = threading.Lock()
+
+
+def get_bundle():
+    '''Return the asset bundle, or None if there isn't a usable one.'''
+    global bundle
+    with bundle_lock:
+        if bundle is None:
+            try:
+                bundle = Bundle(bundle_path)
+            except (IOError, OSError, ValueError, struct.error), e:
+                if os.path.exists(bundle_path):
+                    print >>sys.stderr, "Warning: ignoring asset bundle: %s" % e
+                bundle = False
+        return bundle or None
+
+
+stale_warned = False
+
+
+def warn_stale_bundle():
+    global stale_warned
+    if not stale_warned:
+        stale_warned = True
+        print >>sys.stderr, ("Warning: %s is out of date; loading changed files "
+            "from %s instead. Rebuild it with python -m artattack.bundle" % (bundle_path, data_dir))
+
+
+def get_bundled(name, path):
+    '''Return the asset bundle if it has an up-to-date copy of name, else None.'''
+    b = get_bundle()
+    if b and name in b and b.is_current(name, path):
+        return b
+    return None
+
+
+class NullSound(object):
+    '''Stands in for a pygame Sound in headless mode.'''
+
+    def play(self, *args, **kwargs):
+        pass
+
+    def stop(self):
+        pass
+
+
+def decode_sprite(fname):
+    '''Decode a sprite without converting it to the display format.
+
+    Unlike load_sprite() this is safe to call from any thread.
+    '''
+    import pygame
+    if headless:
+        return pygame.Surface((1, 1), pygame.SRCALPHA, 32)
+    name = 'sprites/' + fname
+    path = filepath(fname, subdir='sprites')
+    b = get_bundled(name, path)
+    if b:
+        info = b.get_info(name)
+        return pygame.image.frombuffer(b.get_buffer(name), (info['width'], info['height']), 'RGBA')
+    return pygame.image.load(path)
 
 
 def load_sprite(fname):
-    import pygame.image
-    return pygame.image.load(filepath(fname, subdir='sprites')).convert_alpha()
+    surface = decode_sprite(fname)
+    if headless:
+        return surface
+    return surface.convert_alpha()
 
 
 def load_sound(fname):
+    if headless:
+        return NullSound()
     import pygame.mixer
-    return pygame.mixer.Sound(filepath(fname, subdir='sounds'))
+    name = 'sounds/' + fname
+    path = filepath(fname, subdir='sounds')
+    b = get_bundled(name, path)
+    if b:
+        return pygame.mixer.Sound(StringIO(b.get_bytes(name)))
+    return pygame.mixer.Sound(path)
@@ -1,6 +1,8 @@
 import sys
+import zlib
 import os.path
 import random
+import hashlib
 
 import pygame
 from pygame.locals import *
@@ -20,6 +22,7 @@ from .keybindings import get_keybindings
 from .keycontroller import KeyController
 from .powerups import PowerupFactory
 from .signals import Signal
+from .profiler import get_profiler
 
 WINNER_RED = 0
 WINNER_BLUE = 1
@@ -80,6 +83,10 @@ class GameplayGameState(Loadable):
         self.update_time(dt)
         self.world.update(dt)
 
+    def set_interpolation(self, alpha):
+        if self.world:
+            self.world.interpolation = alpha
+
     def draw(self, screen):
         self.world.draw(screen)
         if self.timelimit:
@@ -135,6 +142,9 @@ class GameStateController(object):
     def draw(self, screen):
         self.gs.draw(screen)
 
+    def set_interpolation(self, alpha):
+        self.g.set_interpolation(alpha)
+
     def handle_pc_hit(self, pc, attack_vector):
         pc.hit(attack_vector)
 
@@ -168,6 +178,9 @@ class NetworkController(GameStateController):
     tick_timer = 0 # how long till next tick
     ticks = 0 # how many ticks 
 
+    PAINTING_CHUNK_SIZE = 16 * 1024  # bytes of compressed painting per message
+    CHECKSUM_TICKS = 4  # ticks between the client checksumming the artworks
+
     def draw(self, screen):
         if self.gs:
             self.gs.draw(screen)
@@ -177,7 +190,8 @@ class NetworkController(GameStateController):
         self.status = msg
 
     def update(self, dt):
-        self.process_request()
+        with get_profiler().section('net'):
+            self.process_request()
         if self.started:
             for k in self.keycontrollers:
                 k.update(dt)
@@ -246,29 +260,38 @@ class NetworkController(GameStateController):
         self.set_status(errorstr)
         self.started = False
 
+    def handle_disconnect(self, payload):
+        """The other end has closed the connection, so end the game."""
+        if isinstance(self.gs, EndGameState):
+            return  # It closed after the game was over
+        self.set_status('Opponent disconnected.')
+        self.keycontrollers = []
+        if self.started:
+            self.gs = EndGameState(self.g, self.g.get_winner())
+            self.gs.on_finish.connect(self.on_gameover_finish)
+
     def on_paint(self, player, tool, colour):
         msg = (
             player.ID,
-            tool.__class__,
+            TOOLS.index(tool.__class__),
             tool.pos.to_net(),
             colour
         )
         self.net.send_message(OP_PAINT, msg)
 
     def handle_paint(self, player_tool):
-        playerid, tool_class, pos, colour = player_tool
+        playerid, tool_index, pos, colour = player_tool
         world = self.g.world
         pos = ArtworkPosition.from_net(pos, world)
-        tool = tool_class(world, pos)
+        tool = TOOLS[tool_index](world, pos)
 
         pc = world.players[playerid].pc
         tool.paint(colour, sound=not pc.is_painting())
         pc.paint()
-    
-        
 
-        #TODO: server should sync back the pixels under the tool
-        # to eliminate race conditions with one player overpainting the other
+        # If this paint crosses with one from the other player, the artworks
+        # can end up different; the client's checksums reveal this and the
+        # host sends back its copy of the affected tiles (see send_tiles())
 
     def attack(self, pc, region):
         self.net.send_message(OP_ATTACK, (pc.id, pc.pos))
@@ -299,12 +322,38 @@ class NetworkController(GameStateController):
             a = world.get_actor_for_id(id)
             a.pos = pos
 
+    def send_painting(self, net, digest):
+        """Send the painting to a peer that requested it."""
+        painting = self.g.world.painting
+        if digest != painting.digest:
+            return
+        data = zlib.compress(painting.pngdata, 9)
+        for offset in xrange(0, len(data), self.PAINTING_CHUNK_SIZE):
+            chunk = data[offset:offset + self.PAINTING_CHUNK_SIZE]
+            net.send_message(OP_PAINTING_DATA, (digest, offset, len(data), chunk))
+
+    def send_tiles(self, net, checksums):
+        """Send a peer the tiles of an artwork whose checksums differ from ours."""
+        serial, index, theirs = checksums
+        artworks = self.g.world.artworks
+        if not 0 <= index < len(artworks):
+            return
+        canvas = artworks[index].canvas
+        ours = canvas.tile_checksums()
+        if len(theirs) != len(ours):
+            return
+        rects = canvas.tile_rects()
+        tiles = [(i, canvas.get_rect(rects[i])) for i, (a, b) in enumerate(zip(theirs, ours)) if a != b]
+        if tiles:
+            net.send_message(OP_TILES, (serial, index, tiles))
+
 
 class HostController(NetworkController):
     # A mapping of operation to handler
     HANDLERS = {
         OP_VERSION_MISMATCH: 'handle_version_mismatch',
         OP_ERR: 'handle_network_error',
+        OP_DISCONNECT: 'handle_disconnect',
         OP_CONNECT: 'on_connect',
         OP_START: 'send_start',
         OP_PALETTE_CHANGE: 'handle_palette_change',
@@ -313,6 +362,8 @@ class HostController(NetworkController):
         OP_ENDGAME: 'handle_end_game',
         OP_ATTACK: 'handle_attack',
         OP_POS: 'handle_position',
+        OP_PAINTING_REQUEST: 'handle_painting_request',
+        OP_TILE_CHECKSUMS: 'handle_tile_checksums',
     }
 
     def __init__(self, painting, timelimit=120, port=DEFAULT_PORT):
@@ -352,7 +403,8 @@ class HostController(NetworkController):
         self.net.send_message(OP_ENDGAME, winner)
 
     def on_powerup_spawn(self, powerup):
-        self.net.send_message(OP_POWERUP_SPAWN, (powerup.__class__, powerup.id, powerup.to_net()))
+        cls_index = PowerupFactory.POWERUPS.index(powerup.__class__)
+        self.net.send_message(OP_POWERUP_SPAWN, (cls_index, powerup.id, powerup.to_net()))
 
     def on_connect(self, remote_addr):
         self.set_status("Client connected.")
@@ -362,11 +414,18 @@ class HostController(NetworkController):
         world = self.g.world
         self.net.send_message(OP_GAMECONFIG, {
             'timelimit': self.g.timelimit,
-            'painting': world.painting,
+            'player': world.blue_player.ID,
+            'painting': world.painting.digest,
             'red_palette': world.red_player.palette.to_net(),
             'blue_palette': world.blue_player.palette.to_net(),
         }) 
 
+    def handle_painting_request(self, digest):
+        self.send_painting(self.net, digest)
+
+    def handle_tile_checksums(self, checksums):
+        self.send_tiles(self.net, checksums)
+
     def send_start(self, ready):
         self.started = True
         world = self.g.world
@@ -382,6 +441,7 @@ class ClientController(NetworkController):
     HANDLERS = {
         OP_GAMECONFIG: 'configure_game',
         OP_ERR: 'handle_network_error',
+        OP_DISCONNECT: 'handle_disconnect',
         OP_VERSION_MISMATCH: 'handle_version_mismatch',
         OP_START: 'handle_start',
         OP_PALETTE_CHANGE: 'handle_palette_change',
@@ -392,6 +452,8 @@ class ClientController(NetworkController):
         OP_ATTACK: 'handle_attack',
         OP_HIT: 'handle_hit',
         OP_POS: 'handle_position',
+        OP_PAINTING_DATA: 'handle_painting_data',
+        OP_TILES: 'handle_tiles',
     }
 
     def __init__(self, host, port=DEFAULT_PORT):
@@ -401,15 +463,23 @@ class ClientController(NetworkController):
         self.keycontrollers = []
         self.g = GameplayGameState(None, 0)
         self.gs = ConnectingGameState()
+
+        # Serial number of the next set of artwork checksums, and the serial
+        # at the time we last painted each (artwork, tile)
+        self.checksum_serial = 0
+        self.painted_tiles = {}
+
         self.net.start()
 
     def get_controllers(self, red, blue):
         keybindings = get_keybindings()
         return [
-            KeyController(blue, keybindings['cursors']),
+            KeyController(self.player, keybindings['cursors']),
         ]
 
     def end_game(self):
+        # Stop taking input, as the server won't apply moves made after this
+        self.keycontrollers = []
         self.net.send_message(OP_ENDGAME, None)
 
     def handle_end_game(self, winner):
@@ -421,10 +491,46 @@ class ClientController(NetworkController):
         self.start_game()
 
     def configure_game(self, configdict):
+        self.config = configdict
+        painting = Painting.from_digest(configdict['painting'])
+        if painting is None:
+            # Ask the host to send it
+            self.painting_chunks = []
+            self.painting_received = 0
+            self.set_status('Downloading painting...')
+            self.net.send_message(OP_PAINTING_REQUEST, configdict['painting'])
+        else:
+            self.setup_game(painting)
+
+    def handle_painting_data(self, chunk):
+        digest, offset, total, data = chunk
+        if digest != self.config['painting'] or offset != self.painting_received:
+            return
+        self.painting_chunks.append(data)
+        self.painting_received += len(data)
+        if self.painting_received < total:
+            self.set_status('Downloading painting... %d%%' % (self.painting_received * 100 // total))
+            return
+
+        try:
+            pngdata = zlib.decompress(''.join(self.painting_chunks))
+        except zlib.error:
+            pngdata = None
+        if pngdata is None or hashlib.sha1(pngdata).hexdigest() != digest:
+            self.handle_network_error('The painting was corrupted in transfer.')
+            return
+        painting = Painting.from_pngdata(pngdata)
+        painting.cache()
+        self.set_status('')
+        self.setup_game(painting)
+
+    def setup_game(self, painting):
+        configdict = self.config
         self.gs = self.g
         self.g.set_timelimit(configdict['timelimit'])
-        world = World(configdict['painting'], powerups=False)
+        world = World(painting, powerups=False)
         self.gs.world = world
+        self.player = world.players[configdict['player']]
 
         self.handle_palette_change((0, configdict['red_palette']))
         self.handle_palette_change((1, configdict['blue_palette']))
@@ -436,15 +542,16 @@ class ClientController(NetworkController):
     def connect_game_signals(self):
         self.g.on_time_over.connect(self.end_game)
         world = self.g.world
-        world.blue_player.on_palette_change.connect(self.on_palette_change)
-        world.blue_player.on_tool_move.connect(self.on_tool_move)
-        world.blue_player.on_paint.connect(self.on_paint)
-        world.blue_player.on_attack.connect(self.attack)
+        self.player.on_palette_change.connect(self.on_palette_change)
+        self.player.on_tool_move.connect(self.on_tool_move)
+        self.player.on_paint.connect(self.on_paint)
+        self.player.on_attack.connect(self.attack)
         self.keycontrollers = self.get_controllers(world.red_player, world.blue_player)
 
     def handle_powerup_spawn(self, powerup):
         world = self.g.world
-        cls, id, net = powerup
+        cls_index, id, net = powerup
+        cls = PowerupFactory.POWERUPS[cls_index]
         inst = cls.from_net(net, world.painting.get_palette_map())
         world.spawn_powerup(inst, id=id)
 
@@ -460,10 +567,47 @@ class ClientController(NetworkController):
         # Wait for the server to end the game
         pass
 
-    def tick(self):
-        """Sync the position of the blue player."""
+    def on_paint(self, player, tool, colour):
+        super(ClientController, self).on_paint(player, tool, colour)
+        canvas = tool.pos.get_artwork().canvas
+        for i in canvas.tiles_overlapping(tool.footprint_rect()):
+            self.painted_tiles[tool.pos.artwork, i] = self.checksum_serial
+
+    def send_checksums(self):
+        """Send the host checksums of the artworks, so that it can repair any
+        tiles that differ from its copy."""
+        for i, artwork in enumerate(self.g.world.artworks):
+            checksums = artwork.canvas.tile_checksums()
+            self.net.send_message(OP_TILE_CHECKSUMS, (self.checksum_serial, i, checksums))
+        self.checksum_serial += 1
+
+    def handle_tiles(self, payload):
+        serial, index, tiles = payload
         world = self.g.world
-        self.send_position([world.blue_player.pc])
+        if world is None or not 0 <= index < len(world.artworks):
+            print "ClientController: refused tiles for unknown artwork %d" % index
+            return
+        artwork = world.artworks[index]
+        rects = artwork.canvas.tile_rects()
+        for i, pixels in tiles:
+            if not 0 <= i < len(rects):
+                print "ClientController: refused unknown tile %d" % i
+                continue
+            x, y, w, h = rects[i]
+            if len(pixels) != w * h:
+                print "ClientController: refused tile %d of %d pixels, expected %d" % (i, len(pixels), w * h)
+                continue
+            if self.painted_tiles.get((index, i), -1) > serial:
+                # We painted this tile after sending the checksums, and the
+                # host's copy doesn't have that yet
+                continue
+            artwork.apply_tile(rects[i], pixels)
+
+    def tick(self):
+        """Sync the position of our player, and periodically check the artworks."""
+        self.send_position([self.player.pc])
+        if self.ticks % self.CHECKSUM_TICKS == 0:
+            self.send_checksums()
 
 
 class BannerGameState(Loadable):
@@ -0,0 +1,40 @@
+"""Run the game simulation without a display or audio device.
+
+This is intended for dedicated servers, bots and benchmarks. Headless mode
+replaces sprites with blank surfaces and sounds with silent stand-ins, and
+artworks are scored without being rendered.
+
+Call init() before anything else loads game assets, eg.
+
+    from artattack import headless
+    headless.init()
+    g = headless.create_gamestate('hills.png')
+    for i in range(300):
+        g.update(1.0 / 30)
+
+"""
+
+from .data import set_headless
+
+
+def init():
+    """Switch the game into headless mode."""
+    set_headless()
+
+
+def create_world(painting, powerups=True):
+    """Create a World for painting, which is a filename or a Painting."""
+    from .artwork import Painting
+    from .world import World
+    if not isinstance(painting, Painting):
+        painting = Painting(painting)
+    return World(painting, powerups=powerups)
+
+
+def create_gamestate(painting, timelimit=120, powerups=True):
+    """Create a gameplay state for painting, ready to be stepped with update()."""
+    from .game import GameplayGameState
+    g = GameplayGameState(None, timelimit)
+    g.world = create_world(painting, powerups=powerups)
+    g.world.give_colour()
+    return g
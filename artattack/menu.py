@@ -11,6 +11,7 @@ from .data import filepath
 from .animation import Loadable, sprite
 from .game import TwoPlayerController, HostController, ClientController
 from .text import Label
+from .assets import registry
 
 
 class Button(object):
@@ -242,6 +243,7 @@ class MainMenu(Menu):
         MainMenu.load()
         Brush.load()
         self.setup_buttons()
+        self.progress_label = Label((512, 560), align=Label.ALIGN_CENTRE, colour='#808080')
 
     def setup_buttons(self):
         local_game = Button('local_game', (512, 158)) 
@@ -272,6 +274,10 @@ class MainMenu(Menu):
         super(MainMenu, self).draw(screen)
         self.draw_brush(screen)
 
+        progress = registry.load_progress()
+        if progress < 1:
+            self.progress_label.draw(screen, 'Loading... %d%%' % (progress * 100))
+
 
 class JoinMenu(Menu):
     SPRITES = {
@@ -313,7 +319,7 @@ class JoinMenu(Menu):
         super(JoinMenu, self).draw(screen)
         self.host_label.draw(screen, self.host)
         
-        lw, lh = self.host_label.text_surface.get_size()
+        lw, lh = self.host_label.get_size()
         ax, ay = self.host_label.anchor
         pygame.draw.rect(screen, Color('white'), Rect((ax + lw, ay), (1, lh)), 0)
 
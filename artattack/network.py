@@ -1,82 +1,423 @@
+"""Networking for two-player games.
+
+All connections are serviced by a single Reactor thread, which waits in
+select() for any of their sockets to become readable or writable. The game
+thread talks to a connection through its send_message() and
+receive_message() methods, which pass messages through queues; sending a
+message wakes the reactor so that it is written immediately.
+
+"""
+
+import os
+import sys
 import time
+import errno
 import struct
-from cPickle import loads, dumps, PicklingError, UnpicklingError
 import socket
+import threading
+import traceback
+
+# Name lookups on the reactor thread need this codec. Import it now, as a
+# thread importing it while the main thread holds the import lock deadlocks.
+import encodings.idna
 
-from threading import Thread
 from Queue import Queue, Empty
 
-from select import select
+from select import select, error as select_error
 
 from artattack import VERSION, REVISION, VERSION_STRING
-
-OP_VERSION_MISMATCH = -3 # Versions didn't match
-OP_DISCONNECT = -2 # Disconnect
-OP_ERR = -1 # Socket error
-OP_CONNECT = 0  # Connection established
-OP_START = 1    # Client/server ready, commence game
-OP_NAME = 2    # My name is
-OP_GAMECONFIG = 3    # Server sends painting and time limit
-OP_GIVE_COLOUR = 4  # Give colour, at the start of the game
-OP_POWERUP_SPAWN = 5 # Powerup spawned
-OP_PALETTE_CHANGE = 6  # Palette changed (order/colours etc)
-OP_TOOL_MOVE = 7 # Player tool moved
-OP_PAINT = 8 # Player used a tool
-OP_ENDGAME = 9 # The game is over
-OP_ATTACK = 10 # A player is attacking
-OP_HIT = 11 # A player has been hit
-OP_VERSION = 12  # The version of the game
-OP_POS = 13  # Sync position of an actor or actors
+from .protocol import *
 
 DEFAULT_PORT = 9067
 
+# Each message is sent as its length followed by its data
+FRAME_HEADER = struct.Struct('!I')
+
+# The largest frame a peer may send. Larger frames are refused before any
+# space is allocated for them, as the length comes from the peer.
+MAX_FRAME_SIZE = 256 * 1024
+
+KEEPALIVE_INTERVAL = 1.0  # seconds of silence after which to send a keepalive
+RECEIVE_TIMEOUT = 6.0  # seconds of silence after which the connection is interrupted
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+try:
+    from time import monotonic
+except ImportError:
+    if os.name == 'posix':
+        def monotonic():
+            """Elapsed real time, which unlike time.time() never jumps."""
+            return os.times()[4]
+    else:
+        monotonic = time.time
+
+
+def socketpair():
+    """Return a pair of connected sockets."""
+    try:
+        return socket.socketpair()
+    except AttributeError:
+        # Not available on Windows
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        a = socket.create_connection(listener.getsockname())
+        b, addr = listener.accept()
+        listener.close()
+        return a, b
+
+
+class Reactor(threading.Thread):
+    """Services the sockets of any number of handlers on one thread.
+
+    A handler has the methods fileno(), wants_read(), wants_write(),
+    handle_read(), handle_write(), handle_timer(now) and close(), and a
+    keeprunning attribute. Once keeprunning is False the handler is removed
+    and closed. A handler whose file descriptor stops being valid is crashed()
+    first.
+
+    """
+    TICK = 0.25  # Longest time to wait before calling handle_timer()
+
+    def __init__(self):
+        super(Reactor, self).__init__(name='network')
+        self.daemon = True
+        self.handlers = set()
+        self.lock = threading.Lock()
+        self.wake_r, self.wake_w = socketpair()
+        self.wake_r.setblocking(0)
+        self.wake_w.setblocking(0)
+
+    def add(self, handler):
+        with self.lock:
+            self.handlers.add(handler)
+        self.wake()
+
+    def remove(self, handler):
+        with self.lock:
+            self.handlers.discard(handler)
+
+    def wake(self):
+        """Interrupt select() so that the handlers are checked again."""
+        try:
+            self.wake_w.send('\0')
+        except socket.error:
+            pass  # Already full of wakeups
+
+    def in_reactor_thread(self):
+        return threading.current_thread() is self
+
+    def run(self):
+        while True:
+            with self.lock:
+                handlers = list(self.handlers)
+
+            readers = [self.wake_r]
+            writers = []
+            for h in handlers:
+                if h.wants_read():
+                    readers.append(h)
+                if h.wants_write():
+                    writers.append(h)
+            try:
+                rlist, wlist, xlist = select(readers, writers, [], self.TICK)
+            except (select_error, socket.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                # Probably EBADF, from a socket that was closed under its
+                # handler. Drop the handlers with bad sockets, or select()
+                # would fail every time.
+                traceback.print_exc()
+                if not self.drop_bad_handlers(handlers):
+                    time.sleep(self.TICK)
+                continue
+
+            if self.wake_r in rlist:
+                try:
+                    while self.wake_r.recv(4096):
+                        pass
+                except socket.error:
+                    pass
+
+            rlist = set(rlist)
+            wlist = set(wlist)
+            now = monotonic()
+            for h in handlers:
+                self.dispatch(h, h in rlist, h in wlist, now)
+
+    def drop_bad_handlers(self, handlers):
+        """Crash and remove handlers whose fileno() isn't an open file.
+
+        Return whether any were removed.
+        """
+        dropped = False
+        for h in handlers:
+            try:
+                os.fstat(h.fileno())
+            except (EnvironmentError, AttributeError, ValueError):
+                h.crashed()
+                self.remove(h)
+                h.close()
+                dropped = True
+        return dropped
+
+    def dispatch(self, handler, readable, writable, now):
+        try:
+            if writable and handler.keeprunning:
+                handler.handle_write(now)
+            if readable and handler.keeprunning:
+                handler.handle_read(now)
+            if handler.keeprunning:
+                handler.handle_timer(now)
+        except Exception:
+            traceback.print_exc()
+            handler.crashed()
+        if not handler.keeprunning:
+            self.remove(handler)
+            handler.close()
+
+
+reactor = None
+reactor_lock = threading.Lock()
+
+
+def get_reactor():
+    """Get the shared reactor, starting it if necessary."""
+    global reactor
+    with reactor_lock:
+        if reactor is None:
+            reactor = Reactor()
+            reactor.start()
+        return reactor
+
+
+class ReceiveBuffer(object):
+    """Accumulates received data and splits it into frames in place.
+
+    Data is received directly into a bytearray. Frames are parsed where they
+    lie, and the space taken up by parsed frames is only reclaimed when the
+    buffer needs room for more data.
+
+    """
+    RECV_SIZE = 4096  # Space to make available for each recv
+
+    def __init__(self, size=64 * 1024):
+        self.buf = bytearray(size)
+        self.start = 0  # Offset of the first unparsed byte
+        self.end = 0  # Offset after the last received byte
+
+        self.bytes_received = 0
+        self.frames_received = 0
+        self.high_water = 0  # Most unparsed data the buffer has held
+
+    def __len__(self):
+        return self.end - self.start
+
+    def frame_size(self):
+        """Return the size of the next frame, which must be at least partly received."""
+        size, = FRAME_HEADER.unpack_from(self.buf, self.start)
+        if size > MAX_FRAME_SIZE:
+            raise ProtocolError("Frame of %d bytes is larger than the maximum of %d" % (size, MAX_FRAME_SIZE))
+        return size
+
+    def reserve(self, size):
+        """Ensure there is space to receive size more bytes."""
+        if len(self.buf) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if self.start:
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        if len(self.buf) - self.end < size:
+            self.buf.extend(bytearray(max(size, len(self.buf))))
+
+    def recv_from(self, sock):
+        """Receive whatever data is available from sock.
 
-class BaseConnection(Thread):
+        Returns the number of bytes received, which is 0 if the connection has
+        been closed. Raises ProtocolError if the peer announces a frame larger
+        than MAX_FRAME_SIZE.
+
+        """
+        needed = self.RECV_SIZE
+        if len(self) >= FRAME_HEADER.size:
+            # Make room for the whole of the frame we're waiting for
+            size = self.frame_size()
+            needed = max(needed, FRAME_HEADER.size + size - len(self))
+        self.reserve(needed)
+
+        view = memoryview(self.buf)[self.end:]
+        n = sock.recv_into(view)
+        self.end += n
+        self.bytes_received += n
+        self.high_water = max(self.high_water, len(self))
+        return n
+
+    def frames(self):
+        """Generate (start, end) offsets into buf of the complete frames received.
+
+        Each frame must be dealt with before asking for the next. Raises
+        ProtocolError on reaching a frame larger than MAX_FRAME_SIZE.
+
+        """
+        while len(self) >= FRAME_HEADER.size:
+            size = self.frame_size()
+            start = self.start + FRAME_HEADER.size
+            end = start + size
+            if end > self.end:
+                break
+            self.start = end
+            self.frames_received += 1
+            yield start, end
+        if self.start == self.end:
+            # Everything has been parsed; start again at the beginning
+            self.start = self.end = 0
+
+
+class BaseConnection(object):
+    """A connection that exchanges messages with a remote peer.
+
+    Messages are sent with send_message() and received with
+    receive_message(), from any thread. Connection events and errors are
+    received as messages too; see the OP_* constants.
+
+    """
     def __init__(self):
-        super(BaseConnection, self).__init__()
         self.send_queue = Queue()
         self.receive_queue = Queue()
-        self.read_buf = ''
+        self.read_buf = ReceiveBuffer()
+        self.write_buf = ''
+        self.coalesced = 0  # count of superseded messages that were dropped
 
         self.keeprunning = True
-        self.daemon = True
+        self.connected = False
+        self.verified = False  # whether the remote peer's version matches ours
         self.socket = None
+        self.reactor = get_reactor()
+        self.closed = threading.Event()
+
+        self.last_rx = self.last_tx = monotonic()
+        self.interrupted = False
+
+    def start(self):
+        """Start establishing the connection."""
+        self.reactor.add(self)
 
     def send_message(self, op, payload):
-        buf = dumps((op, payload), -1)
-        self.send_queue.put(buf)
+        buf = encode_message(op, payload)
+        self.send_queue.put((coalesce_key(op, payload), buf))
+        self.reactor.wake()
 
     def receive_message(self):
         return self.receive_queue.get_nowait()
 
-    def disconnect(self):
+    def disconnect(self, timeout=1.0):
+        """Close the connection, waiting up to timeout seconds for it to be
+        closed cleanly."""
+        self.keeprunning = False
+        if self.socket and not self.reactor.in_reactor_thread():
+            self.reactor.wake()
+            if timeout:
+                self.closed.wait(timeout)
+        else:
+            self.close()
+
+    def on_connect(self, sock, remote_addr):
+        """Called when the socket is connected to the remote peer."""
+        sock.setblocking(0)
+        self.socket = sock
+        self.remote_addr = remote_addr
+        self.connected = True
+        self.last_rx = self.last_tx = monotonic()
+        self.receive_queue.put((OP_CONNECT, remote_addr))
+
+        # The version must be the first thing sent, ahead of anything queued
+        buf = encode_message(OP_VERSION, (VERSION, REVISION, PROTOCOL_VERSION))
+        self.write_buf = FRAME_HEADER.pack(len(buf)) + buf + self.write_buf
+
+    def on_error(self, e):
+        self.receive_queue.put((OP_ERR, e.strerror or str(e)))
+        self.keeprunning = False
+
+    def crashed(self):
+        self.receive_queue.put((OP_ERR, "Networking crashed :("))
         self.keeprunning = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def wants_read(self):
+        return self.connected
+
+    def wants_write(self):
+        return self.connected and bool(self.write_buf or self.send_queue.qsize())
+
+    def handle_read(self, now):
+        self.last_rx = now
+        self.interrupted = False
+        self._read_socket()
+
+    def handle_write(self, now):
+        self.last_tx = now
         try:
-            self.join()
-        except RuntimeError:
-            pass
+            self._write_socket()
+        except socket.error, e:
+            self.on_error(e)
+
+    def handle_timer(self, now):
+        if not self.connected:
+            return
+        if now - self.last_tx > KEEPALIVE_INTERVAL:
+            self.send_keepalive_packet()
+            self.last_tx = now
+        if now - self.last_rx > RECEIVE_TIMEOUT and not self.interrupted:
+            self.interrupted = True
+            self.receive_queue.put((OP_ERR, 'Connection interruped.'))
 
     def _read_socket(self):
         try:
-            b = self.socket.recv(4096)
+            received = self.read_buf.recv_from(self.socket)
         except socket.error, e:
-            self.receive_queue.put((OP_ERR, e.strerror))
-            self.disconnect()
+            if e.errno in WOULD_BLOCK:
+                return
+            self.on_error(e)
+            return
+        except ProtocolError, e:
+            self.on_protocol_error(e)
             return
 
-        self.read_buf += b
-        while len(self.read_buf) > 4:
-            size = struct.unpack('!I', self.read_buf[:4])[0]
-            if len(self.read_buf) < size + 4:
-#                print "waiting for", len(self.read_buf) - size - 4, "more bytes"
-                break
-            chunk = self.read_buf[4:size + 4]
-            self.read_buf = self.read_buf[size + 4:]
-            if chunk:
-                self._recv_chunk(chunk)
-    
-    def _recv_chunk(self, chunk):
-        payload = loads(chunk)
+        if not received:
+            # The remote end has closed the connection
+            self.keeprunning = False
+            return
+
+        buf = self.read_buf.buf
+        try:
+            for start, end in self.read_buf.frames():
+                if end > start:
+                    self._recv_chunk(buf, start, end)
+        except ProtocolError, e:
+            self.on_protocol_error(e)
+
+    def on_protocol_error(self, e):
+        """The stream can't be parsed any further, so close the connection."""
+        self.receive_queue.put((OP_ERR, "Bad message received: %s" % e))
+        self.keeprunning = False
+
+    def _recv_chunk(self, buf, start, end):
+        try:
+            payload = decode_message(buf, start, end)
+        except ProtocolError, e:
+            if self.handle_chunk == self.handle_chunk_initial:
+                # Probably an old version that doesn't speak this protocol
+                payload = (None, None)
+            else:
+                self.receive_queue.put((OP_ERR, "Bad message received: %s" % e))
+                return
         self.handle_chunk(payload)
 
     def handle_chunk_initial(self, payload):
@@ -91,7 +432,12 @@ class BaseConnection(Thread):
             self.receive_queue.put((OP_VERSION_MISMATCH, "Remote player has an outdated version."))
             return
 
-        version, revision = v
+        version, revision, protocol = v
+        if protocol != PROTOCOL_VERSION:
+            self.receive_queue.put((OP_VERSION_MISMATCH, "Remote player uses a different network protocol."))
+            self.keeprunning = False
+            return
+
         if revision != REVISION or version != VERSION:
             c = cmp(version, VERSION)
             messages = [
@@ -102,7 +448,8 @@ class BaseConnection(Thread):
             self.receive_queue.put((OP_VERSION_MISMATCH, messages[c] % {'version': VERSION_STRING}))
             self.keeprunning = False
             return
-        
+
+        self.verified = True
         self.handle_chunk = self.handle_chunk_main
 
     def handle_chunk_main(self, payload):
@@ -110,141 +457,199 @@ class BaseConnection(Thread):
 
     handle_chunk = handle_chunk_initial
 
+    def _drain_send_queue(self):
+        """Take all queued messages, dropping any superseded by later ones."""
+        bufs = []
+        latest = {}
+        while True:
+            try:
+                key, buf = self.send_queue.get_nowait()
+            except Empty:
+                break
+            if key is not None:
+                if key in latest:
+                    bufs[latest[key]] = None
+                    self.coalesced += 1
+                latest[key] = len(bufs)
+            bufs.append(buf)
+        return [b for b in bufs if b is not None]
+
     def _write_socket(self):
-        try:
-            buf = self.send_queue.get_nowait()
-        except Empty:
+        bufs = self._drain_send_queue()
+        if bufs:
+            self.write_buf += ''.join(FRAME_HEADER.pack(len(b)) + b for b in bufs)
+        if not self.write_buf:
             return
 
-        size = struct.pack('!I', len(buf))
+        # The socket may accept only part of the buffer; send the rest later
+        try:
+            sent = self.socket.send(self.write_buf)
+        except socket.error, e:
+            if e.errno in WOULD_BLOCK:
+                return
+            raise
+        self.write_buf = self.write_buf[sent:]
 
-#        print "Sending", len(size) + len(buf), "bytes"
+    def send_keepalive_packet(self):
+        self.send_queue.put((None, ''))
 
-        self.socket.send(size + buf)
+    def __del__(self):
+        self.close()
 
-    def send_keepalive_packet(self):
-        self.send_queue.put('')
+    def close(self):
+        """Close the socket, telling the remote peer first if possible."""
+        if self.socket:
+            sock = self.socket
+            self.socket = None
+            self.connected = False
+            self.send_message(OP_DISCONNECT, None)
+            bufs = self._drain_send_queue()
+            data = self.write_buf + ''.join(FRAME_HEADER.pack(len(b)) + b for b in bufs)
+            try:
+                # Flush whatever can be sent without blocking
+                sock.send(data)
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        self.closed.set()
 
-    def establish_connection(self):
-        """Subclasses should implement this method to block until a connection is successfully established
-        or self.keeprunning is False
-        
-        """
-        raise NotImplementedError("Implement this")
 
-    def send_version(self):
-        self.send_message(OP_VERSION, (VERSION, REVISION))
+class Listener(object):
+    """Accepts connections on a port, passing each to on_accept(sock, addr).
 
-    def run(self):
-        try:
-            self.establish_connection()
-        except socket.error, e:
-            self.receive_queue.put((OP_ERR, e.strerror))
-            return
+    This is a reactor handler, like BaseConnection.
 
-        self.send_version()
+    """
+    def __init__(self, port, on_accept, backlog=32):
+        self.on_accept = on_accept
+        self.keeprunning = True
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('0.0.0.0', port))
+        self.socket.listen(backlog)
+        self.socket.setblocking(0)
 
-        t = 0
-        last_rx = 0
-        last_tx = 0
-        try:
-            while self.keeprunning:
-                if self.send_queue.qsize():
-                    wlist = [self.socket]
-                elif t - last_tx > 50:
-                    self.send_keepalive_packet()
-                    wlist = [self.socket]
-                else:
-                    wlist = []
-                rlist, wlist, xlist = select([self.socket], wlist, [self.socket], 0.02)
-
-                if not (rlist or wlist or xlist):
-                    t += 1
-                    if t - last_rx == 300:
-                        self.receive_queue.put((OP_ERR, 'Connection interruped.'))
+    def fileno(self):
+        return self.socket.fileno()
 
-                try:
-                    if wlist:
-                        self._write_socket()
-                        last_tx = t
-                    if rlist:
-                        self._read_socket()
-                        last_rx = t
-                except:
-                    import traceback
-                    traceback.print_exc()
-                    self.receive_queue.put((OP_ERR, "Networking crashed :("))
-                    break
-        finally:
-            self.close()
+    def wants_read(self):
+        return True
 
-    def __del__(self):
-        self.close()
-    
-    def close(self):
-        if self.socket:
-            buf = dumps((OP_DISCONNECT, 0))
-            size = struct.pack('!I', len(buf))
+    def wants_write(self):
+        return False
+
+    def handle_read(self, now):
+        while self.keeprunning:
             try:
-                self.socket.send(size + buf)
-                self.socket.shutdown(socket.SHUT_RDWR)
-                self.socket.close()
+                conn, address = self.socket.accept()
             except socket.error:
-                pass
+                return
+            self.on_accept(conn, address)
+
+    def handle_write(self, now):
+        pass
+
+    def handle_timer(self, now):
+        pass
+
+    def crashed(self):
+        self.keeprunning = False
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
 
 
 class ServerSocket(BaseConnection):
+    """A connection that waits for a single client to connect to it."""
+
     def __init__(self, port=DEFAULT_PORT):
         super(ServerSocket, self).__init__()
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.IPPROTO_IP, socket.SO_REUSEADDR, 1)
+        self.listener = None
         try:
-            self.server_socket.bind(('0.0.0.0', port))
+            self.listener = Listener(port, self.on_accept, backlog=1)
         except socket.error, e:
             self.receive_queue.put((OP_ERR, "Cannot start server: " + e.strerror))
-        self.server_socket.listen(1)
-        self.server_socket.setblocking(0)
-        self.socket = None
 
-    def wait_for_connection(self):
-        try:
-            r = self.server_socket.accept()
-        except socket.error:
-            return False
-        if r:
-            conn, address = r
+    def start(self):
+        if self.listener:
+            self.reactor.add(self.listener)
 
-            self.socket = conn
-            self.remote_addr = address
-            return True
-        return False
+    def on_accept(self, sock, address):
+        # Accept only the first client
+        self.listener.keeprunning = False
+        if not self.keeprunning:
+            sock.close()
+            return
+        self.on_connect(sock, address)
+        self.reactor.add(self)
 
-    def on_connection_receive(self):
-        self.receive_queue.put((OP_CONNECT, self.remote_addr))
+    def disconnect(self, timeout=1.0):
+        if self.listener:
+            self.listener.keeprunning = False
+            self.reactor.wake()
+        super(ServerSocket, self).disconnect(timeout)
 
-    def establish_connection(self):
-        while self.keeprunning:
-            if self.wait_for_connection():
-                break
-            time.sleep(0.2)
-        if self.socket:
-            self.on_connection_receive()
 
-    def close(self):
-        super(ServerSocket, self).close()
-        self.server_socket.close()
+class AcceptedConnection(BaseConnection):
+    """A connection to a client accepted by a Listener."""
+
+    def __init__(self, sock, address):
+        super(AcceptedConnection, self).__init__()
+        self.accepted = (sock, address)
+
+    def start(self):
+        self.on_connect(*self.accepted)
+        self.reactor.add(self)
 
 
 class ClientSocket(BaseConnection):
+    """A connection to a server at host:port."""
+
     def __init__(self, host, port=DEFAULT_PORT):
         super(ClientSocket, self).__init__()
         self.remote_addr = ((host, port))
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
-    def establish_connection(self):
-        self.socket.connect(self.remote_addr)
-        self.receive_queue.put((OP_CONNECT, self.remote_addr))
+        self.connecting = False
+
+    def wants_write(self):
+        return self.connecting or super(ClientSocket, self).wants_write()
+
+    def handle_timer(self, now):
+        if self.socket is None:
+            self.start_connect()
+        super(ClientSocket, self).handle_timer(now)
+
+    def start_connect(self):
+        # This runs on the reactor thread, so that resolving the host name
+        # doesn't hold up the game
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            err = sock.connect_ex(self.remote_addr)
+        except socket.error, e:
+            self.on_error(e)
+            return
+        self.socket = sock
+        if err in CONNECT_IN_PROGRESS:
+            self.connecting = True
+        elif err:
+            self.on_error(socket.error(err, os.strerror(err)))
+        else:
+            self.on_connect(sock, self.remote_addr)
+
+    def handle_write(self, now):
+        if self.connecting:
+            self.connecting = False
+            err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.on_error(socket.error(err, os.strerror(err)))
+            else:
+                self.on_connect(self.socket, self.remote_addr)
+            return
+        super(ClientSocket, self).handle_write(now)
 
 
 if __name__ == '__main__':
@@ -3,6 +3,7 @@ from pygame.locals import *
 
 from .data import *
 from .animation import Sprite
+from .assets import registry
 
 
 del color
@@ -44,10 +45,10 @@ class PaintColour(object):
 
     @classmethod
     def load(cls):
-        cls.colour_mask = load_sprite('colour-mask.png')
-        cls.colour_overlay = load_sprite('colour-overlay.png')
-        cls.paint_can_mask = load_sprite('paint-can-mask.png')
-        cls.paint_can_base = load_sprite('paint-can-base.png')
+        cls.colour_mask = registry.surface('colour-mask.png')
+        cls.colour_overlay = registry.surface('colour-overlay.png')
+        cls.paint_can_mask = registry.surface('paint-can-mask.png')
+        cls.paint_can_base = registry.surface('paint-can-base.png')
 
     def draw_swatch(self, screen, pos):
         screen.blit(self.swatch, pos)
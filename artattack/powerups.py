@@ -52,7 +52,7 @@ class Powerup(Actor):
         if self.age > self.LIFETIME - self.BLINK_TIME:
             if int((self.age - (self.LIFETIME - self.BLINK_TIME)) / self.BLINK_RATE) % 2 == 0:
                 return
-        x, y = floor_to_screen(self.pos)
+        x, y = floor_to_screen(self.draw_pos())
         self.sprite_instance.draw(screen, (x, y - self.alt))
 
 
@@ -0,0 +1,187 @@
+"""Per-frame timing instrumentation.
+
+The game loop times each stage of a frame with a FrameProfiler. The profiler
+keeps a rolling window of timings from which it computes percentiles, can
+draw them as an overlay, and can stream every frame's timings to a CSV or
+JSON lines file for later analysis.
+
+Code outside the game loop can time itself against the installed profiler:
+
+    with get_profiler().section('net'):
+        ...
+
+"""
+
+import json
+from collections import deque
+from timeit import default_timer
+
+
+SECTIONS = ('events', 'update', 'net', 'draw', 'flip')
+
+
+class Section(object):
+    """Context manager that adds the time spent within it to a profiler."""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = default_timer()
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, default_timer() - self.start)
+
+
+class NullSection(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullProfiler(object):
+    """A profiler that records nothing."""
+
+    def section(self, name):
+        return NullSection()
+
+    def add(self, name, elapsed):
+        pass
+
+
+class FrameProfiler(object):
+    """Collects the time spent in each section of each frame.
+
+    Nested sections are not subtracted from their parents; eg. 'net' is
+    spent within 'update'.
+
+    """
+    WINDOW = 300  # Number of frames to compute percentiles over
+    SUMMARY_INTERVAL = 15  # Frames between recomputing the overlay's figures
+    PERCENTILES = (50, 95, 99)
+
+    # Overlay layout
+    OVERLAY_RECT = (372, 6, 280, 122)
+    ROW_HEIGHT = 16
+    COLUMN_WIDTH = 52
+
+    def __init__(self, log=None):
+        self.samples = dict((name, deque(maxlen=self.WINDOW)) for name in ('frame',) + SECTIONS)
+        self.current = {}
+        self.frame = 0
+        self.frame_start = None
+        self.visible = False
+        self.labels = None
+        self.summary = []
+
+        self.log = None
+        if log:
+            self.open_log(log)
+
+    def open_log(self, filename):
+        """Stream per-frame timings to filename, as CSV if it ends in .csv
+        or JSON lines otherwise."""
+        self.log = open(filename, 'w')
+        self.log_csv = filename.lower().endswith('.csv')
+        if self.log_csv:
+            self.log.write(','.join(('frame', 'frame_ms') + tuple('%s_ms' % s for s in SECTIONS)) + '\n')
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def toggle(self):
+        """Show or hide the overlay."""
+        self.visible = not self.visible
+        if self.visible:
+            self.summary = self.format_summary()
+
+    def section(self, name):
+        return Section(self, name)
+
+    def add(self, name, elapsed):
+        self.current[name] = self.current.get(name, 0) + elapsed
+
+    def start_frame(self):
+        self.current = {}
+        self.frame_start = default_timer()
+
+    def end_frame(self):
+        if self.frame_start is None:
+            return
+        self.current['frame'] = default_timer() - self.frame_start
+        for name, samples in self.samples.iteritems():
+            samples.append(self.current.get(name, 0))
+        if self.log:
+            self.write_log()
+        self.frame += 1
+        if self.visible and self.frame % self.SUMMARY_INTERVAL == 0:
+            self.summary = self.format_summary()
+
+    def write_log(self):
+        ms = [self.current.get(name, 0) * 1000 for name in ('frame',) + SECTIONS]
+        if self.log_csv:
+            self.log.write('%d,' % self.frame + ','.join('%.3f' % t for t in ms) + '\n')
+        else:
+            record = dict(zip(['%s_ms' % name for name in ('frame',) + SECTIONS], ms))
+            record['frame'] = self.frame
+            self.log.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def percentiles(self, name):
+        """Return the PERCENTILES and maximum of a section's times, in seconds."""
+        samples = sorted(self.samples[name])
+        if not samples:
+            return [0] * (len(self.PERCENTILES) + 1)
+        n = len(samples)
+        ps = [samples[min(n - 1, n * p // 100)] for p in self.PERCENTILES]
+        return ps + [samples[-1]]
+
+    def format_summary(self):
+        """Tabulate the percentiles of each section as rows of strings."""
+        rows = [[''] + ['p%d' % p for p in self.PERCENTILES] + ['max']]
+        for name in ('frame',) + SECTIONS:
+            rows.append([name] + ['%.1fms' % (t * 1000) for t in self.percentiles(name)])
+        return rows
+
+    def create_labels(self):
+        from .text import Label
+        x, y, w, h = self.OVERLAY_RECT
+        self.labels = []
+        for j in range(len(SECTIONS) + 2):
+            ly = y + 4 + j * self.ROW_HEIGHT
+            row = [Label((x + 6, ly), size=14)]
+            for i in range(len(self.PERCENTILES) + 1):
+                lx = x + 70 + (i + 1) * self.COLUMN_WIDTH - 8
+                row.append(Label((lx, ly), align=Label.ALIGN_RIGHT, size=14))
+            self.labels.append(row)
+
+    def draw(self, screen):
+        """Draw the overlay, if visible."""
+        if not self.visible:
+            return
+        import pygame
+        if self.labels is None:
+            self.create_labels()
+            self.background = pygame.Surface(self.OVERLAY_RECT[2:], pygame.SRCALPHA)
+            self.background.fill((0, 0, 0, 160))
+        screen.blit(self.background, self.OVERLAY_RECT[:2])
+        for labels, cells in zip(self.labels, self.summary):
+            for label, text in zip(labels, cells):
+                label.draw(screen, text)
+
+
+installed = NullProfiler()
+
+
+def install(profiler):
+    """Make profiler the target of get_profiler()."""
+    global installed
+    installed = profiler
+
+
+def get_profiler():
+    return installed
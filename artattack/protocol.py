@@ -0,0 +1,477 @@
+"""The binary encoding of network messages.
+
+Each message is an (op, payload) pair. On the wire it is the op, as a signed
+byte, followed by the payload packed with the codec registered for that op.
+Payloads contain only numbers and strings; classes are referred to by their
+index in a registry that both peers share, eg. PowerupFactory.POWERUPS.
+
+The layout of OP_VERSION must never change, so that peers can always tell
+each other which PROTOCOL_VERSION they speak. Increment PROTOCOL_VERSION when
+changing the layout of any other message.
+
+"""
+
+import struct
+from struct import Struct
+
+from vector import Vector
+
+
+__all__ = [
+    'PROTOCOL_VERSION', 'ProtocolError', 'encode_message', 'decode_message',
+    'coalesce_key',
+    'OP_VERSION_MISMATCH', 'OP_DISCONNECT', 'OP_ERR', 'OP_CONNECT', 'OP_START',
+    'OP_NAME', 'OP_GAMECONFIG', 'OP_GIVE_COLOUR', 'OP_POWERUP_SPAWN',
+    'OP_PALETTE_CHANGE', 'OP_TOOL_MOVE', 'OP_PAINT', 'OP_ENDGAME', 'OP_ATTACK',
+    'OP_HIT', 'OP_VERSION', 'OP_POS', 'OP_PAINTING_REQUEST', 'OP_PAINTING_DATA',
+    'OP_TILE_CHECKSUMS', 'OP_TILES',
+]
+
+PROTOCOL_VERSION = 5
+
+OP_VERSION_MISMATCH = -3 # Versions didn't match
+OP_DISCONNECT = -2 # Disconnect
+OP_ERR = -1 # Socket error
+OP_CONNECT = 0  # Connection established
+OP_START = 1    # Client/server ready, commence game
+OP_NAME = 2    # My name is
+OP_GAMECONFIG = 3    # Server sends painting and time limit
+OP_GIVE_COLOUR = 4  # Give colour, at the start of the game
+OP_POWERUP_SPAWN = 5 # Powerup spawned
+OP_PALETTE_CHANGE = 6  # Palette changed (order/colours etc)
+OP_TOOL_MOVE = 7 # Player tool moved
+OP_PAINT = 8 # Player used a tool
+OP_ENDGAME = 9 # The game is over
+OP_ATTACK = 10 # A player is attacking
+OP_HIT = 11 # A player has been hit
+OP_VERSION = 12  # The version of the game
+OP_POS = 13  # Sync position of an actor or actors
+OP_PAINTING_REQUEST = 14  # Client doesn't have the painting, please send it
+OP_PAINTING_DATA = 15  # A chunk of the compressed painting
+OP_TILE_CHECKSUMS = 16  # Client's checksums of the tiles of an artwork
+OP_TILES = 17  # Host's copy of tiles whose checksums didn't match
+
+
+class ProtocolError(Exception):
+    """A message could not be encoded or decoded."""
+
+
+HEADER = Struct('!b')
+
+codecs = {}
+
+
+def register(op):
+    """Class decorator that registers a codec for op."""
+    def register_codec(cls):
+        codecs[op] = cls()
+        return cls
+    return register_codec
+
+
+def encode_message(op, payload):
+    """Encode a message as a string."""
+    try:
+        codec = codecs[op]
+    except KeyError:
+        raise ProtocolError("No codec for op %r" % op)
+    try:
+        return HEADER.pack(op) + codec.encode(payload)
+    except (struct.error, TypeError, ValueError), e:
+        raise ProtocolError("Cannot encode op %d payload %r: %s" % (op, payload, e))
+
+
+def decode_message(buf, offset=0, end=None):
+    """Decode the message in buf[offset:end] into (op, payload).
+
+    buf may be any object supporting the buffer interface.
+
+    """
+    if end is None:
+        end = len(buf)
+    try:
+        op, = HEADER.unpack_from(buf, offset)
+    except struct.error:
+        raise ProtocolError("Empty message")
+    try:
+        codec = codecs[op]
+    except KeyError:
+        raise ProtocolError("Unknown op %d" % op)
+    try:
+        payload, pos = codec.decode(buf, offset + HEADER.size)
+    except (struct.error, TypeError, ValueError), e:
+        raise ProtocolError("Malformed op %d message: %s" % (op, e))
+    if pos != end:
+        raise ProtocolError("Op %d message has %d trailing bytes" % (op, end - pos))
+    return op, payload
+
+
+def coalesce_key(op, payload):
+    """Return a key identifying what a message updates, or None.
+
+    A queued message may be dropped in favour of a later one with the same
+    key, as the later message supersedes it.
+
+    """
+    key = codecs[op].key(payload)
+    if key is None:
+        return None
+    return op, key
+
+
+# Helpers for variable-length fields. Decoders take a buffer and an offset
+# and return the decoded value and the offset after it.
+
+COUNT = Struct('!B')
+LENGTH = Struct('!I')
+
+
+def pack_string(s):
+    return LENGTH.pack(len(s)) + s
+
+
+def unpack_string(buf, pos):
+    size, = LENGTH.unpack_from(buf, pos)
+    pos += LENGTH.size
+    s = str(buffer(buf, pos, size))
+    if len(s) != size:
+        raise ValueError("String truncated")
+    return s, pos + size
+
+
+def pack_bytes(values):
+    return COUNT.pack(len(values)) + struct.pack('!%dB' % len(values), *values)
+
+
+def unpack_bytes(buf, pos):
+    count, = COUNT.unpack_from(buf, pos)
+    pos += COUNT.size
+    values = list(struct.unpack_from('!%dB' % count, buf, pos))
+    return values, pos + count
+
+
+class Codec(object):
+    """Encodes and decodes the payloads of one op."""
+
+    def key(self, payload):
+        """Messages that just set some state can return a key for that state,
+        so that superseded messages can be dropped; see coalesce_key()."""
+        return None
+
+    def encode(self, payload):
+        raise NotImplementedError("Implement this")
+
+    def decode(self, buf, pos):
+        raise NotImplementedError("Implement this")
+
+
+class NoPayload(Codec):
+    """A message with no payload."""
+
+    def encode(self, payload):
+        return ''
+
+    def decode(self, buf, pos):
+        return None, pos
+
+
+register(OP_START)(NoPayload)
+register(OP_DISCONNECT)(NoPayload)
+
+
+@register(OP_VERSION)
+class Version(Codec):
+    """(version tuple, revision string, protocol version)"""
+    header = Struct('!HB')
+
+    def encode(self, payload):
+        version, revision, protocol = payload
+        return (self.header.pack(protocol, len(version)) +
+            struct.pack('!%dH' % len(version), *version) +
+            pack_string(revision))
+
+    def decode(self, buf, pos):
+        protocol, length = self.header.unpack_from(buf, pos)
+        pos += self.header.size
+        version = struct.unpack_from('!%dH' % length, buf, pos)
+        pos += 2 * length
+        revision, pos = unpack_string(buf, pos)
+        return (version, revision, protocol), pos
+
+
+@register(OP_NAME)
+class Name(Codec):
+    def encode(self, payload):
+        return pack_string(payload)
+
+    def decode(self, buf, pos):
+        return unpack_string(buf, pos)
+
+
+class Palette(object):
+    """(selected index or None, [colour index, ...])"""
+    struct = Struct('!B')
+    NONE = 255
+
+    @classmethod
+    def pack(cls, palette):
+        selected, colours = palette
+        if selected is None:
+            selected = cls.NONE
+        return cls.struct.pack(selected) + pack_bytes(colours)
+
+    @classmethod
+    def unpack(cls, buf, pos):
+        selected, = cls.struct.unpack_from(buf, pos)
+        if selected == cls.NONE:
+            selected = None
+        colours, pos = unpack_bytes(buf, pos + cls.struct.size)
+        return (selected, colours), pos
+
+
+@register(OP_GAMECONFIG)
+class GameConfig(Codec):
+    """A dict of timelimit, player, painting, red_palette and blue_palette.
+
+    player is the ID of the player that the recipient controls. painting is
+    the hex SHA-1 digest of the painting's PNG data, which the recipient can
+    request with OP_PAINTING_REQUEST if it doesn't have it.
+
+    """
+    struct = Struct('!IB20s')
+
+    def encode(self, payload):
+        return (self.struct.pack(payload['timelimit'], payload['player'],
+                payload['painting'].decode('hex')) +
+            Palette.pack(payload['red_palette']) +
+            Palette.pack(payload['blue_palette']))
+
+    def decode(self, buf, pos):
+        timelimit, player, digest = self.struct.unpack_from(buf, pos)
+        pos += self.struct.size
+        red_palette, pos = Palette.unpack(buf, pos)
+        blue_palette, pos = Palette.unpack(buf, pos)
+        return {
+            'timelimit': timelimit,
+            'player': player,
+            'painting': digest.encode('hex'),
+            'red_palette': red_palette,
+            'blue_palette': blue_palette,
+        }, pos
+
+
+@register(OP_POWERUP_SPAWN)
+class PowerupSpawn(Codec):
+    """(powerup class index, actor id, (pos, colour index))"""
+    struct = Struct('!BIddB')
+
+    def encode(self, payload):
+        cls, id, (pos, colour) = payload
+        x, y = pos
+        return self.struct.pack(cls, id, x, y, colour)
+
+    def decode(self, buf, pos):
+        cls, id, x, y, colour = self.struct.unpack_from(buf, pos)
+        return (cls, id, (Vector((x, y)), colour)), pos + self.struct.size
+
+
+@register(OP_PALETTE_CHANGE)
+class PaletteChange(Codec):
+    """(player id, palette)"""
+    struct = Struct('!B')
+
+    def key(self, payload):
+        return payload[0]
+
+    def encode(self, payload):
+        playerid, palette = payload
+        return self.struct.pack(playerid) + Palette.pack(palette)
+
+    def decode(self, buf, pos):
+        playerid, = self.struct.unpack_from(buf, pos)
+        palette, pos = Palette.unpack(buf, pos + self.struct.size)
+        return (playerid, palette), pos
+
+
+@register(OP_TOOL_MOVE)
+class ToolMove(Codec):
+    """(player id, (artwork, x, y))"""
+    struct = Struct('!BBhh')
+
+    def key(self, payload):
+        return payload[0]
+
+    def encode(self, payload):
+        playerid, (artwork, x, y) = payload
+        return self.struct.pack(playerid, artwork, x, y)
+
+    def decode(self, buf, pos):
+        playerid, artwork, x, y = self.struct.unpack_from(buf, pos)
+        return (playerid, (artwork, x, y)), pos + self.struct.size
+
+
+@register(OP_PAINT)
+class Paint(Codec):
+    """(player id, tool class index, (artwork, x, y), colour index)"""
+    struct = Struct('!BBBhhB')
+
+    def encode(self, payload):
+        playerid, tool, (artwork, x, y), colour = payload
+        return self.struct.pack(playerid, tool, artwork, x, y, colour)
+
+    def decode(self, buf, pos):
+        playerid, tool, artwork, x, y, colour = self.struct.unpack_from(buf, pos)
+        return (playerid, tool, (artwork, x, y), colour), pos + self.struct.size
+
+
+@register(OP_ENDGAME)
+class EndGame(Codec):
+    """The winner, or None if the game isn't decided yet."""
+    struct = Struct('!b')
+    NONE = -128
+
+    def encode(self, payload):
+        if payload is None:
+            payload = self.NONE
+        return self.struct.pack(payload)
+
+    def decode(self, buf, pos):
+        winner, = self.struct.unpack_from(buf, pos)
+        if winner == self.NONE:
+            winner = None
+        return winner, pos + self.struct.size
+
+
+@register(OP_ATTACK)
+class Attack(Codec):
+    """(actor id, pos)"""
+    struct = Struct('!Idd')
+
+    def encode(self, payload):
+        id, (x, y) = payload
+        return self.struct.pack(id, x, y)
+
+    def decode(self, buf, pos):
+        id, x, y = self.struct.unpack_from(buf, pos)
+        return (id, Vector((x, y))), pos + self.struct.size
+
+
+@register(OP_HIT)
+class Hit(Codec):
+    """(actor id, attack vector, stun time)"""
+    struct = Struct('!Iddd')
+
+    def encode(self, payload):
+        id, (x, y), stun = payload
+        return self.struct.pack(id, x, y, stun)
+
+    def decode(self, buf, pos):
+        id, x, y, stun = self.struct.unpack_from(buf, pos)
+        return (id, Vector((x, y)), stun), pos + self.struct.size
+
+
+@register(OP_POS)
+class Positions(Codec):
+    """[(actor id, pos), ...]"""
+    count = Struct('!H')
+    struct = Struct('!Idd')
+
+    def key(self, payload):
+        return tuple(id for id, pos in payload)
+
+    def encode(self, payload):
+        parts = [self.count.pack(len(payload))]
+        for id, (x, y) in payload:
+            parts.append(self.struct.pack(id, x, y))
+        return ''.join(parts)
+
+    def decode(self, buf, pos):
+        count, = self.count.unpack_from(buf, pos)
+        pos += self.count.size
+        actors = []
+        for i in xrange(count):
+            id, x, y = self.struct.unpack_from(buf, pos)
+            actors.append((id, Vector((x, y))))
+            pos += self.struct.size
+        return actors, pos
+
+
+@register(OP_PAINTING_REQUEST)
+class PaintingRequest(Codec):
+    """The hex SHA-1 digest of the painting wanted."""
+    struct = Struct('!20s')
+
+    def encode(self, payload):
+        return self.struct.pack(payload.decode('hex'))
+
+    def decode(self, buf, pos):
+        digest, = self.struct.unpack_from(buf, pos)
+        return digest.encode('hex'), pos + self.struct.size
+
+
+@register(OP_PAINTING_DATA)
+class PaintingData(Codec):
+    """(digest, offset, total size, data)
+
+    The painting's PNG data is compressed with zlib and sent in chunks; data
+    is the part of the compressed stream starting at offset.
+
+    """
+    struct = Struct('!20sII')
+
+    def encode(self, payload):
+        digest, offset, total, data = payload
+        return self.struct.pack(digest.decode('hex'), offset, total) + pack_string(data)
+
+    def decode(self, buf, pos):
+        digest, offset, total = self.struct.unpack_from(buf, pos)
+        data, pos = unpack_string(buf, pos + self.struct.size)
+        return (digest.encode('hex'), offset, total, data), pos
+
+
+@register(OP_TILE_CHECKSUMS)
+class TileChecksums(Codec):
+    """(serial, artwork, [checksum of each tile, ...])"""
+    struct = Struct('!IBH')
+
+    def key(self, payload):
+        return payload[1]
+
+    def encode(self, payload):
+        serial, artwork, checksums = payload
+        return (self.struct.pack(serial, artwork, len(checksums)) +
+            struct.pack('!%dI' % len(checksums), *checksums))
+
+    def decode(self, buf, pos):
+        serial, artwork, count = self.struct.unpack_from(buf, pos)
+        pos += self.struct.size
+        checksums = list(struct.unpack_from('!%dI' % count, buf, pos))
+        return (serial, artwork, checksums), pos + 4 * count
+
+
+@register(OP_TILES)
+class Tiles(Codec):
+    """(serial, artwork, [(tile index, pixels), ...])
+
+    serial is that of the OP_TILE_CHECKSUMS message this replies to.
+
+    """
+    struct = Struct('!IBH')
+    tile = Struct('!H')
+
+    def encode(self, payload):
+        serial, artwork, tiles = payload
+        parts = [self.struct.pack(serial, artwork, len(tiles))]
+        for index, pixels in tiles:
+            parts.append(self.tile.pack(index) + pack_string(pixels))
+        return ''.join(parts)
+
+    def decode(self, buf, pos):
+        serial, artwork, count = self.struct.unpack_from(buf, pos)
+        pos += self.struct.size
+        tiles = []
+        for i in xrange(count):
+            index, = self.tile.unpack_from(buf, pos)
+            pixels, pos = unpack_string(buf, pos + self.tile.size)
+            tiles.append((index, pixels))
+        return (serial, artwork, tiles), pos
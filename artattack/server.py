@@ -0,0 +1,350 @@
+"""A dedicated server that hosts network games between remote players.
+
+The server runs headless. Clients connect to it as they would to a player
+hosting a game, and are paired into matches in the order they arrive; the
+first of each pair plays red and the second blue. Every match has its own
+World, which the server keeps authoritative just as HostController does:
+it spawns powerups and decides hits, and relays each player's moves to their
+opponent.
+
+All connections are serviced by the shared network reactor, so one process
+can run many matches at once. Start a server with
+
+    python run_game.py --dedicated PORT
+
+"""
+
+import os
+import time
+import random
+import traceback
+from Queue import Queue, Empty
+
+from . import headless
+from .data import filepath
+from .artwork import Painting
+from .paint import PaintColour
+from .world import World
+from .game import GameplayGameState, NetworkController
+from .powerups import PowerupFactory
+from .tools import TOOLS
+from .network import Listener, AcceptedConnection, DEFAULT_PORT, RECEIVE_TIMEOUT, monotonic, get_reactor
+from .protocol import *
+
+
+TICK_RATE = 30  # simulation updates per second
+
+# If the simulation falls further behind than this many ticks, drop the
+# excess time rather than trying to catch up
+MAX_TICKS = 5
+
+
+class Match(NetworkController):
+    """A game between two remote players.
+
+    The connections are indexed by the ID of the player they control.
+    Messages about a player are only accepted from that player's connection,
+    and only if every index in them is in range.
+
+    """
+    HANDLERS = {
+        OP_CONNECT: 'handle_connect',
+        OP_VERSION_MISMATCH: 'handle_network_error',
+        OP_ERR: 'handle_network_error',
+        OP_DISCONNECT: 'handle_disconnect',
+        OP_START: 'handle_start',
+        OP_PALETTE_CHANGE: 'handle_palette_change',
+        OP_TOOL_MOVE: 'handle_tool_move',
+        OP_PAINT: 'handle_paint',
+        OP_ENDGAME: 'handle_end_game',
+        OP_ATTACK: 'handle_attack',
+        OP_POS: 'handle_position',
+        OP_PAINTING_REQUEST: 'handle_painting_request',
+        OP_TILE_CHECKSUMS: 'handle_tile_checksums',
+    }
+
+    # Moves that are passed on to the other player as soon as they arrive.
+    # Positions are instead synced to both players every tick.
+    RELAYED = (OP_PALETTE_CHANGE, OP_TOOL_MOVE, OP_PAINT, OP_ATTACK)
+
+    # How far outside the floor space an actor may be, eg. once knocked back
+    FLOOR_MARGIN = 200
+
+    def __init__(self, id, painting, timelimit, connections):
+        self.id = id
+        self.connections = connections
+        self.ready = set()  # IDs of the players ready to start
+        self.finished = set()  # IDs of the players whose time has run out
+        self.over = False
+
+        self.g = GameplayGameState(None, timelimit)
+        world = self.g.world = World(painting)
+        world.give_colour()
+        world.on_pc_hit.connect(self.handle_pc_hit)
+        world.on_powerup_spawn.connect(self.on_powerup_spawn)
+
+        for player in world.players:
+            self.send_gameconfig(player)
+
+    def log(self, msg):
+        print "Match %d: %s" % (self.id, msg)
+
+    def broadcast(self, op, payload):
+        for net in self.connections:
+            net.send_message(op, payload)
+
+    def send_gameconfig(self, player):
+        world = self.g.world
+        self.connections[player.ID].send_message(OP_GAMECONFIG, {
+            'timelimit': self.g.timelimit,
+            'player': player.ID,
+            'painting': world.painting.digest,
+            'red_palette': world.red_player.palette.to_net(),
+            'blue_palette': world.blue_player.palette.to_net(),
+        })
+
+    def update(self, dt):
+        self.process_request()
+        if self.started and not self.over:
+            self.g.update(dt)
+
+            self.tick_timer += dt
+            if self.tick_timer > self.TICK_INTERVAL:
+                self.ticks += 1
+                self.tick()
+                self.tick_timer = 0
+
+    def process_request(self):
+        for playerid, net in enumerate(self.connections):
+            while not self.over:
+                try:
+                    op, payload = net.receive_message()
+                except Empty:
+                    break
+
+                try:
+                    handler = self.HANDLERS[op]
+                except KeyError:
+                    self.log("unhandled opcode %d from player %d" % (op, playerid))
+                    continue
+                if op in self.RELAYED and playerid in self.finished:
+                    # The player's time is up
+                    continue
+                error = self.check_message(playerid, op, payload)
+                if error:
+                    self.log("refused op %d from player %d: %s" % (op, playerid, error))
+                    continue
+
+                self.sender = playerid
+                getattr(self, handler)(payload)
+                if op in self.RELAYED:
+                    self.connections[1 - playerid].send_message(op, payload)
+
+    def check_message(self, playerid, op, payload):
+        """Return why a message from playerid can't be accepted, or None."""
+        world = self.g.world
+        pc = world.players[playerid].pc
+        if op in (OP_PALETTE_CHANGE, OP_TOOL_MOVE, OP_PAINT):
+            if payload[0] != playerid:
+                return "it is for their opponent"
+        elif op == OP_ATTACK:
+            if payload[0] != pc.id:
+                return "it is for their opponent"
+        elif op == OP_POS:
+            if any(id != pc.id for id, pos in payload):
+                return "it is for their opponent"
+
+        colours = world.painting.get_palette_map()
+        if op == OP_PALETTE_CHANGE:
+            selected, palette = payload[1]
+            if any(c not in colours for c in palette):
+                return "unknown colour"
+            if selected is not None and not 0 <= selected < len(palette):
+                return "selected colour out of range"
+        elif op == OP_TOOL_MOVE:
+            if not self.is_valid_position(payload[1]):
+                return "position out of range"
+        elif op == OP_PAINT:
+            playerid, tool, pos, colour = payload
+            if not 0 <= tool < len(TOOLS):
+                return "unknown tool"
+            if colour not in colours:
+                return "unknown colour"
+            if not self.is_valid_position(pos):
+                return "position out of range"
+        elif op == OP_ATTACK:
+            if not self.is_valid_floor_pos(payload[1]):
+                return "position out of range"
+        elif op == OP_POS:
+            if not all(self.is_valid_floor_pos(pos) for id, pos in payload):
+                return "position out of range"
+        return None
+
+    def is_valid_position(self, pos):
+        """Check that a networked ArtworkPosition lies within its domain."""
+        artwork, x, y = pos
+        w, h = self.g.world.painting.canvas.get_size()
+        return (0 <= artwork < len(self.g.world.artworks) and
+            -1 <= x <= w and -1 <= y <= h)
+
+    def is_valid_floor_pos(self, pos):
+        """Check that a networked actor position is on or near the floor.
+
+        This also refuses NaN, which fails every comparison, and infinities.
+        """
+        tl, br = self.g.world.get_floor_space()
+        m = self.FLOOR_MARGIN
+        return (tl.x - m <= pos.x <= br.x + m and
+            tl.y - m <= pos.y <= br.y + m)
+
+    def handle_connect(self, remote_addr):
+        self.log("player %d is %s:%d" % ((self.sender,) + tuple(remote_addr)))
+
+    def handle_network_error(self, errorstr):
+        self.log("player %d: %s" % (self.sender, errorstr))
+        self.end()
+
+    def handle_disconnect(self, payload):
+        self.log("player %d disconnected" % self.sender)
+        self.end()
+
+    def handle_painting_request(self, digest):
+        self.send_painting(self.connections[self.sender], digest)
+
+    def handle_tile_checksums(self, checksums):
+        self.send_tiles(self.connections[self.sender], checksums)
+
+    def handle_start(self, payload):
+        self.ready.add(self.sender)
+        if len(self.ready) == len(self.connections):
+            self.started = True
+            self.broadcast(OP_START, None)
+
+    def handle_end_game(self, payload):
+        # Each player sends this once they have received all of the game's
+        # messages; wait for both before deciding the winner
+        self.finished.add(self.sender)
+        if len(self.finished) == len(self.connections):
+            winner = self.g.get_winner()
+            self.broadcast(OP_ENDGAME, winner)
+            self.log("game over, winner %d" % winner)
+            self.end()
+
+    def handle_pc_hit(self, pc, attack_vector):
+        pc.hit(attack_vector)
+        self.broadcast(OP_HIT, (pc.id, attack_vector, pc.stun))
+
+    def on_powerup_spawn(self, powerup):
+        cls_index = PowerupFactory.POWERUPS.index(powerup.__class__)
+        self.broadcast(OP_POWERUP_SPAWN, (cls_index, powerup.id, powerup.to_net()))
+
+    def tick(self):
+        """Sync game state to each player, except for their own position."""
+        world = self.g.world
+        for player, net in zip(world.players, self.connections):
+            pos = [(a.id, a.pos) for a in world.actors if a is not player.pc]
+            net.send_message(OP_POS, pos)
+
+    def end(self):
+        """Stop the match and close both connections."""
+        if self.over:
+            return
+        self.over = True
+        for net in self.connections:
+            # Don't hold up the other matches waiting for the socket to close
+            net.disconnect(timeout=0)
+
+
+class MatchServer(object):
+    """Pairs up clients as they connect and runs a Match for each pair."""
+
+    def __init__(self, port=DEFAULT_PORT, paintings=None, timelimit=120):
+        headless.init()
+        if paintings is None:
+            paintings = sorted(os.listdir(filepath('paintings')))
+        self.paintings = paintings
+        self.loaded_paintings = {}
+        self.timelimit = timelimit
+
+        self.matches = []
+        self.next_id = 0
+        self.waiting = []  # connected clients not yet in a match
+        self.accepted = Queue()  # new clients, from the reactor thread
+
+        self.reactor = get_reactor()
+        self.listener = Listener(port, self.on_accept)
+
+    def on_accept(self, sock, address):
+        net = AcceptedConnection(sock, address)
+        net.start()
+        self.accepted.put(net)
+
+    def get_painting(self):
+        """Choose a painting at random for a new match."""
+        fname = random.choice(self.paintings)
+        try:
+            return self.loaded_paintings[fname]
+        except KeyError:
+            PaintColour.load()  # a painting's colours need their sprites
+            p = self.loaded_paintings[fname] = Painting(fname)
+            return p
+
+    def matchmake(self):
+        """Start a match for each pair of connected clients."""
+        while True:
+            try:
+                self.waiting.append(self.accepted.get_nowait())
+            except Empty:
+                break
+
+        # Forget clients that left, or whose version didn't match, and close
+        # those that have gone silent, eg. without ever sending their version
+        now = monotonic()
+        for net in self.waiting:
+            if now - net.last_rx > RECEIVE_TIMEOUT:
+                net.disconnect(timeout=0)
+        self.waiting = [net for net in self.waiting if net.keeprunning]
+
+        ready = [net for net in self.waiting if net.verified]
+        while len(ready) >= 2:
+            connections = ready[:2]
+            del ready[:2]
+            for net in connections:
+                self.waiting.remove(net)
+            match = Match(self.next_id, self.get_painting(), self.timelimit, connections)
+            self.next_id += 1
+            self.matches.append(match)
+            match.log("started, %d matches running" % len(self.matches))
+
+    def update(self, dt):
+        self.matchmake()
+        for m in self.matches:
+            try:
+                m.update(dt)
+            except Exception:
+                # Don't let one match take the others down with it
+                traceback.print_exc()
+                m.log("crashed")
+                m.end()
+        self.matches = [m for m in self.matches if not m.over]
+
+    def run(self):
+        self.reactor.add(self.listener)
+        print "Serving on port %d" % self.listener.socket.getsockname()[1]
+
+        step = 1.0 / TICK_RATE
+        next_tick = monotonic()
+        while True:
+            ticks = 0
+            while monotonic() >= next_tick:
+                self.update(step)
+                next_tick += step
+                ticks += 1
+                if ticks >= MAX_TICKS:
+                    next_tick = monotonic() + step
+                    break
+            time.sleep(max(0, next_tick - monotonic()))
+
+
+def serve(port=DEFAULT_PORT, **kwargs):
+    MatchServer(port, **kwargs).run()
@@ -0,0 +1,65 @@
+"""A spatial index of actors in floor space."""
+
+
+class SpatialHash(object):
+    """Buckets objects into a uniform grid of square cells by position.
+
+    Objects must have a pos attribute; the index must be told when it changes
+    by calling move().
+
+    """
+    def __init__(self, cell_size=32):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.object_cells = {}
+
+    def __len__(self):
+        return len(self.object_cells)
+
+    def __contains__(self, obj):
+        return obj in self.object_cells
+
+    def cell_for(self, pos):
+        x, y = pos
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def insert(self, obj):
+        cell = self.cell_for(obj.pos)
+        self.object_cells[obj] = cell
+        self.cells.setdefault(cell, []).append(obj)
+
+    def remove(self, obj):
+        cell = self.object_cells.pop(obj)
+        bucket = self.cells[cell]
+        bucket.remove(obj)
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, obj):
+        """Update the index after obj has moved. Objects not in the index are ignored."""
+        old = self.object_cells.get(obj)
+        if old is None:
+            return
+        cell = self.cell_for(obj.pos)
+        if cell != old:
+            self.remove(obj)
+            self.object_cells[obj] = cell
+            self.cells.setdefault(cell, []).append(obj)
+
+    def query(self, tl, br):
+        """Return a list of objects in cells overlapping the rectangle tl - br.
+
+        This may include objects slightly outside the rectangle; callers
+        should test the positions of the objects returned.
+
+        """
+        x1, y1 = self.cell_for(tl)
+        x2, y2 = self.cell_for(br)
+        found = []
+        cells = self.cells
+        for i in xrange(x1, x2 + 1):
+            for j in xrange(y1, y2 + 1):
+                bucket = cells.get((i, j))
+                if bucket:
+                    found.extend(bucket)
+        return found
@@ -2,11 +2,71 @@ import pygame
 from pygame.locals import Color
 
 
+SHADOW_COLOUR = Color('#00000080')
+
+
+class GlyphAtlas(object):
+    """Pre-rendered characters of one font in one colour.
+
+    Each character is rendered once, along with its shadow, the first time
+    it is used. Text is then drawn by blitting the glyphs side by side.
+
+    """
+    atlases = {}
+
+    def __init__(self, font, colour):
+        self.font = font
+        self.colour = colour
+        self.height = font.get_height()
+        self.glyphs = {}
+
+    @classmethod
+    def get(cls, size, colour):
+        """Get the shared atlas for a font size and colour."""
+        key = (size, tuple(colour))
+        try:
+            return cls.atlases[key]
+        except KeyError:
+            atlas = cls.atlases[key] = cls(Label.load_font(size), colour)
+            return atlas
+
+    def glyph(self, ch):
+        """Return (surface, shadow, advance) for the character ch."""
+        try:
+            return self.glyphs[ch]
+        except KeyError:
+            surface = self.font.render(ch, True, self.colour)
+            shadow = self.font.render(ch, True, SHADOW_COLOUR)
+            metrics = self.font.metrics(ch)
+            if metrics and metrics[0]:
+                advance = metrics[0][4]
+            else:
+                advance = surface.get_width()
+            g = self.glyphs[ch] = (surface, shadow, advance)
+            return g
+
+    def measure(self, text):
+        """Return the width of text."""
+        return sum(self.glyph(ch)[2] for ch in text)
+
+    def layout(self, text, pos):
+        """Return a blit sequence that draws text, with its shadow, at pos."""
+        x, y = pos
+        shadows = []
+        glyphs = []
+        for ch in text:
+            surface, shadow, advance = self.glyph(ch)
+            shadows.append((shadow, (x + 1, y + 1)))
+            glyphs.append((surface, (x, y)))
+            x += advance
+        return shadows + glyphs
+
+
 class Label(object):
     """A label with a fixed position and style, but changing text.
 
-    The label caches its surfaces to avoid re-rendering text that hasn't
-    changed.
+    Text is composed from a GlyphAtlas. The blit sequence is only rebuilt
+    when the text changes.
 
     """
     ALIGN_LEFT = 0
@@ -21,33 +81,44 @@ class Label(object):
         self.colour = Color(colour)
         self.shadow = shadow
         self.text = None
-        self.font = self.load_font(size)
+        self.size = size
+        # Fonts are loaded on first draw, so labels can exist without a display
+        self.atlas = None
+        self.width = 0
+        self.blit_sequence = []
 
     def set_colour(self, colour):
         self.colour = Color(colour)
+        self.atlas = None
         self.text = None
 
+    def get_size(self):
+        """Get the size of the text last drawn."""
+        if self.atlas is None:
+            return 0, 0
+        return self.width, self.atlas.height
+
     def get_position(self):
         if self.align == Label.ALIGN_LEFT:
             return self.anchor
         elif self.align == Label.ALIGN_RIGHT:
             x, y = self.anchor
-            return (x - self.text_surface.get_width(), y)
+            return (x - self.width, y)
         elif self.align == Label.ALIGN_CENTRE:
             x, y = self.anchor
-            return (x - self.text_surface.get_width() // 2, y)
+            return (x - self.width // 2, y)
 
-    def rebuild_surfaces(self):
-        self.text_surface = self.font.render(self.text, True, self.colour)
-        self.shadow_surface = self.font.render(self.text, True, Color('#00000080'))
+    def layout(self):
+        if self.atlas is None:
+            self.atlas = GlyphAtlas.get(self.size, self.colour)
+        self.width = self.atlas.measure(self.text)
+        self.blit_sequence = self.atlas.layout(self.text, self.get_position())
 
     def draw(self, screen, text):
         if text != self.text:
             self.text = text
-            self.rebuild_surfaces()
-        x, y = self.get_position()
-        screen.blit(self.shadow_surface, (x + 1, y + 1))
-        screen.blit(self.text_surface, (x, y))
+            self.layout()
+        screen.blits(self.blit_sequence, doreturn=False)
 
     @classmethod
     def load_font(cls, size):
@@ -19,6 +19,14 @@ class Brush(Loadable):
     }
 
     """A 3x3 brush to paint onto an Artwork"""
+
+    # The pixels painted by the brush, in rows, centred on the brush position
+    FOOTPRINT = (
+        (True, True, True),
+        (True, True, True),
+        (True, True, True),
+    )
+
     def __init__(self, world, pos):
         self.world = world
         self.pos = pos
@@ -64,15 +72,18 @@ class Brush(Loadable):
     def move_down(self):
         self.pos += (0, 1)
 
+    def footprint_rect(self):
+        """Return the rect (x, y, w, h) of the artwork pixels that paint()
+        covers, which may extend outside the artwork."""
+        x, y = self.pos.pos()
+        w = len(self.FOOTPRINT[0])
+        h = len(self.FOOTPRINT)
+        return x - w // 2, y - h // 2, w, h
+
     def paint(self, colour, sound=True):
-        tl = self.topleft()
-        br = self.bottomright()
-        left, top = tl 
-        right, bottom = br
+        x, y, w, h = self.footprint_rect()
         artwork = self.pos.get_artwork()
-        for j in range(top, bottom + 1):
-            for i in range(left, right + 1):
-                artwork.paint_pixel((i, j), colour)
+        artwork.paint_footprint((x, y), self.FOOTPRINT, colour)
         if sound:
             self.play_sound()
 
@@ -81,3 +92,5 @@ class Brush(Loadable):
         sound.play()
 
 
+# All tools; a tool is identified over the network by its index in this list
+TOOLS = [Brush]
@@ -14,9 +14,10 @@ import random
 
 from .artwork import *
 
-from .data import filepath
+from .data import filepath, is_headless
 from .animation import Loadable
 from .signals import Signal
+from .spatial import SpatialHash
 
 from vector import Vector
 
@@ -36,14 +37,28 @@ class Actor(Loadable):
 
     RADIUS = 10
 
+    world = None
+
     def __init__(self, pos):
         self.pos = pos
+        self.prev_pos = pos
         self.sprite = None
         self.play(self.DEFAULT_SPRITE)
 
     def __str__(self):
         return '<%s at %s>' % (self.__class__.__name__, self.pos)
 
+    def get_pos(self):
+        return self._pos
+
+    def set_pos(self, pos):
+        self._pos = pos
+        if self.world is not None:
+            self.world.spatial.move(self)
+
+    # Setting the position keeps the world's spatial index up to date
+    pos = property(get_pos, set_pos)
+
     def kill(self):
         self.world.kill(self)
 
@@ -59,8 +74,15 @@ class Actor(Loadable):
         if hasattr(self.sprite, 'update'):
             self.sprite.update(dt)
 
+    def draw_pos(self):
+        """Compute the floor position to draw at, between the last two ticks."""
+        alpha = self.world.interpolation
+        if alpha >= 1:
+            return self.pos
+        return self.prev_pos + (self.pos - self.prev_pos) * alpha
+
     def draw(self, screen):
-        self.sprite_instance.draw(screen, floor_to_screen(self.pos))
+        self.sprite_instance.draw(screen, floor_to_screen(self.draw_pos()))
 
     def handle_collision(self, ano):
         """Handle a collision between this actor and another.
@@ -187,13 +209,36 @@ class World(object):
         self.next_id = 0
 
         self.painting = painting
-        self.background = pygame.image.load(BACKGROUND).convert()
-        self.actors = []
 
-        outlines = self.painting.build_outline_surface(*ARTWORK_SIZE)
+        # Actors are stored in no particular order, so that they can be
+        # removed by swapping the last actor into their place
+        self.actors = []
+        self.actors_by_id = {}
+
+        # The actors in the order they should be drawn, back to front. Killed
+        # actors are removed lazily; dead_drawn counts those still in it
+        self.draw_order = []
+        self.dead_drawn = 0
+
+        # Index of actors by position, and the largest radius of any actor,
+        # which bounds how far apart colliding actors can be
+        self.spatial = SpatialHash()
+        self.max_radius = 0
+
+        # How far between the previous and current tick to draw actors
+        self.interpolation = 1.0
+
+        if is_headless():
+            # Nothing is drawn, so the artworks don't need display surfaces
+            self.background = None
+            self.red_artwork = Artwork(painting, None, RECT_RED.copy())
+            self.blue_artwork = Artwork(painting, None, RECT_BLUE)
+        else:
+            self.background = pygame.image.load(BACKGROUND).convert()
+            outlines = self.painting.build_outline_surface(*ARTWORK_SIZE)
 
-        self.red_artwork = Artwork(painting, self.background.subsurface(RECT_RED), RECT_RED.copy(), outlines=outlines)
-        self.blue_artwork = Artwork(painting, self.background.subsurface(RECT_BLUE), RECT_BLUE, outlines=outlines)
+            self.red_artwork = Artwork(painting, self.background.subsurface(RECT_RED), RECT_RED.copy(), outlines=outlines)
+            self.blue_artwork = Artwork(painting, self.background.subsurface(RECT_BLUE), RECT_BLUE, outlines=outlines)
 
         # For convenience
         self.artworks = (self.red_artwork, self.blue_artwork)
@@ -220,11 +265,10 @@ class World(object):
         self.on_pc_hit = Signal()
 
     def get_actor_for_id(self, id):
-        # FIXME: use a lookup table for this
-        for a in self.actors:
-            if a.id == id:
-                return a
-        raise ValueError("No actor with id %r" % id)
+        try:
+            return self.actors_by_id[id]
+        except KeyError:
+            raise ValueError("No actor with id %r" % id)
 
     def spawn(self, actor, id=None):
         if id is not None:
@@ -234,11 +278,35 @@ class World(object):
             self.next_id += 1
         actor.world = self
         actor.alive = True
+        actor.world_index = len(self.actors)
         self.actors.append(actor)
+        self.actors_by_id[actor.id] = actor
+        self.draw_order.append(actor)
+        self.spatial.insert(actor)
+        self.max_radius = max(self.max_radius, actor.RADIUS)
 
     def kill(self, actor):
+        if not actor.alive:
+            # Already killed, eg. by two collisions in the same tick
+            return
         actor.alive = False
-        self.actors.remove(actor)
+        last = self.actors.pop()
+        if last is not actor:
+            self.actors[actor.world_index] = last
+            last.world_index = actor.world_index
+        del self.actors_by_id[actor.id]
+        self.spatial.remove(actor)
+
+        # Nothing is drawn in headless mode, so don't wait for a draw to
+        # compact the draw list
+        self.dead_drawn += 1
+        if self.dead_drawn > len(self.draw_order) // 2:
+            self.compact_draw_order()
+
+    def compact_draw_order(self):
+        """Remove killed actors from the draw list."""
+        self.draw_order = [a for a in self.draw_order if a.alive]
+        self.dead_drawn = 0
 
     def spawn_powerup(self, powerup, id=None):
         self.spawn(powerup, id=id)
@@ -270,6 +338,9 @@ class World(object):
                 self.powerup_factory.drop(side)
 
     def update(self, dt):
+        for a in self.actors:
+            a.prev_pos = a.pos
+
         for p in self.players:
             p.update(dt)
 
@@ -282,26 +353,36 @@ class World(object):
             self.powerup_factory.update(dt)
 
     def handle_collisions(self):
-        """Brute force collision detection with O(n^2) time complexity.
+        """Collision detection, using the spatial index to find nearby actors.
+
+        Each pair of actors is considered once, in order of actor id, so that
+        the results are the same on every machine in a network game. If the
+        collision mask of the actor with the lower id matches the collision
+        groups of the other, its handle_collision() is called.
+
         """
-        acs = self.actors[:]
-        for i, a in enumerate(acs):
-            if not a.alive:
+        pairs = []
+        for a in self.actors:
+            if not a.COLLISION_MASK:
                 continue
-
-            for b in acs[i + 1:]:
-                if not b.alive:
+            r = a.RADIUS + self.max_radius
+            x, y = a.pos
+            for b in self.spatial.query((x - r, y - r), (x + r, y + r)):
+                if b.id <= a.id or not (a.COLLISION_MASK & b.COLLISION_GROUPS):
                     continue
+                if (b.pos - a.pos).length2 < (a.RADIUS + b.RADIUS) * (a.RADIUS + b.RADIUS):
+                    pairs.append((a.id, b.id, a, b))
 
-                if a.COLLISION_MASK & b.COLLISION_GROUPS:
-                    if (b.pos - a.pos).length2 < (a.RADIUS + b.RADIUS) * (a.RADIUS + b.RADIUS):
-                        #print a, "collides", b
-                        a.handle_collision(b)
+        pairs.sort()
+        for aid, bid, a, b in pairs:
+            if a.alive and b.alive:
+                #print a, "collides", b
+                a.handle_collision(b)
 
     def actors_in_region(self, tl, br):
         x1, y1 = tl
         x2, y2 = br
-        for a in self.actors:
+        for a in self.spatial.query(tl, br):
             p = a.pos
             if x1 <= p.x < x2 and y1 <= p.y < y2:
                 yield a
@@ -314,10 +395,34 @@ class World(object):
 
         for p in self.players:
             p.draw(screen)
-        self.actors.sort(key=lambda a: a.pos.y)
-        for a in self.actors:
+        self.sort_draw_order()
+        for a in self.draw_order:
             a.draw(screen)
 
+    def sort_draw_order(self):
+        """Restore the back-to-front order of the draw list.
+
+        Actors only move a little between frames, and new actors are few, so
+        the list is nearly sorted and an insertion sort takes close to O(n).
+
+        """
+        if self.dead_drawn:
+            self.compact_draw_order()
+        order = self.draw_order
+        keys = [a.pos.y for a in order]
+        for i in xrange(1, len(order)):
+            y = keys[i]
+            if keys[i - 1] <= y:
+                continue
+            a = order[i]
+            j = i - 1
+            while j >= 0 and keys[j] > y:
+                keys[j + 1] = keys[j]
+                order[j + 1] = order[j]
+                j -= 1
+            keys[j + 1] = y
+            order[j + 1] = a
+
     @staticmethod
     def for_painting(filename):
         painting = Painting(filename)
@@ -11,14 +11,23 @@ if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option('-s', '--serve', help='Host a network game on port PORT', metavar='PORT', type='int')
     parser.add_option('-c', '--connect', help='Connect to a network game on HOST:PORT', metavar='HOST[:PORT]')
+    parser.add_option('-d', '--dedicated', help='Run a headless server for network games between remote players on port PORT', metavar='PORT', type='int')
+    parser.add_option('--profile-log', help='Record frame timings to FILE (.csv for CSV, otherwise JSON lines)', metavar='FILE')
 
     options, args = parser.parse_args()
 
-    if options.serve and options.connect:
-        parser.error("Hosting and connecting are mutually exclusive.")
+    if len(filter(None, [options.serve, options.connect, options.dedicated])) > 1:
+        parser.error("Hosting, connecting and running a dedicated server are mutually exclusive.")
 
-    if options.serve:
-        artattack.__main__.host(port=options.serve)
+    game_options = {}
+    if options.profile_log:
+        game_options['profile_log'] = options.profile_log
+
+    if options.dedicated:
+        import artattack.server
+        artattack.server.serve(port=options.dedicated)
+    elif options.serve:
+        artattack.__main__.host(port=options.serve, **game_options)
     elif options.connect:
         mo = re.match('^([\w.-]+)(:(\d+))?', options.connect)
         if not mo:
@@ -28,6 +37,6 @@ if __name__ == "__main__":
             port = int(mo.group(3))
         else:
             port = DEFAULT_PORT
-        artattack.__main__.connect(host, port)
+        artattack.__main__.connect(host, port, **game_options)
     else:
-        artattack.__main__.menu()
+        artattack.__main__.menu(**game_options)